@@ -1,10 +1,686 @@
+from __future__ import annotations
+
+import collections
+import contextlib
+import functools
+import importlib
+import json
+import mmap
+import operator
+import os
+import pickle
+import queue
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
 import weakref
-import torch
-from typing import List, Union, Type, Any, Dict, Optional, Tuple
+from multiprocessing.reduction import ForkingPickler
+from typing import TYPE_CHECKING, List, Union, Type, Any, Dict, Optional, Tuple, Iterator, Callable, Iterable
+
+class _LazyModule:
+    """Stand-in for a module that is imported on first attribute access, then replaces itself in this module."""
+    __slots__ = ["name"]
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __getattr__(self, attr: str) -> Any:
+        module = importlib.import_module(self.name)
+        globals()[self.name] = module
+        return getattr(module, attr)
+
+if TYPE_CHECKING:
+    import torch
+else:
+    torch = _LazyModule("torch")  # int/float/str-only stores never pay for importing torch
+
+_MAGIC = b"MANGROVE"
+_FORMAT_VERSION = 1
+_ALIGN = 64  # payload alignment, enough for any dtype view and cache-line friendly
+
+def _type_name(t: Type) -> str:
+    return f"{t.__module__}.{t.__qualname__}"
+
+def _resolve_type(qualified: str) -> Type:
+    module, _, qualname = qualified.rpartition(".")
+    while module:
+        try:
+            obj = importlib.import_module(module)
+            break
+        except ImportError:
+            module, _, head = module.rpartition(".")
+            qualname = f"{head}.{qualname}"
+    for part in qualname.split("."):
+        obj = getattr(obj, part)
+    return obj
+
+def _tensor_type() -> Optional[Type]:
+    """torch.Tensor once torch has been imported by anyone, else None; never imports torch itself."""
+    return getattr(sys.modules.get("torch"), "Tensor", None)
+
+def _is_tensor(value: Any) -> bool:
+    # Nothing can be a tensor before torch is loaded, so this is safe on torch-free paths
+    tensor = _tensor_type()
+    return tensor is not None and isinstance(value, tensor)
+
+def _base_types() -> List[Type]:
+    """Types allowed at depth 0: int, float and str, plus torch.Tensor if torch is loaded."""
+    tensor = _tensor_type()
+    return [int, float, str] if tensor is None else [int, float, str, tensor]
+
+def _insert(group: Dict[str, int], name: str, seq: int) -> None:
+    """Add name to an index group, keeping the group ordered by insertion sequence."""
+    if not group or seq > next(reversed(group.values())):
+        group[name] = seq
+        return
+    # A variable moving back into a group it left earlier: re-sort the group
+    items = sorted([*group.items(), (name, seq)], key=operator.itemgetter(1))
+    group.clear()
+    group.update(items)
+
+def _first_seq(group: Dict[str, int]) -> int:
+    return next(iter(group.values()))
+
+def _aligned(offset: int) -> int:
+    return -(-offset // _ALIGN) * _ALIGN
+
+def _writes(method: Callable) -> Callable:
+    """Run a mutating method under the instance lock and publish a new generation, when concurrent mode is on."""
+    label = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self: "Mangrove", *args: Any, **kwargs: Any) -> Any:
+        lock, stats = self.lock, self.stats
+        if lock is None and stats is None:
+            return method(self, *args, **kwargs)
+        outermost = stats is not None and stats.enter()
+        start = time.perf_counter()
+        try:
+            if lock is None:
+                return method(self, *args, **kwargs)
+            with lock:
+                try:
+                    return method(self, *args, **kwargs)
+                finally:
+                    self.generation += 1
+        finally:
+            if stats is not None:
+                stats.leave(label, time.perf_counter() - start, outermost)
+    return wrapper
+
+def _reads(method: Callable) -> Callable:
+    """Serve a query from the current snapshot, when concurrent mode is on."""
+    label = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self: "Mangrove", *args: Any, **kwargs: Any) -> Any:
+        stats = self.stats
+        if stats is None and self.lock is None and self.shared is None:
+            return method(self, *args, **kwargs)
+        outermost = stats is not None and stats.enter()
+        start = time.perf_counter() if stats is not None else 0.0
+        if self.shared is not None:
+            self.shared.sync(self)
+        try:
+            if self.lock is None:
+                return method(self, *args, **kwargs)
+            return method(self.snapshot(), *args, **kwargs)
+        finally:
+            if stats is not None:
+                stats.leave(label, time.perf_counter() - start, outermost)
+    return wrapper
+
+class CallStats:
+    """Call counts and latencies per Mangrove method.
+
+    Totals cover every call; percentiles are taken over the most recent
+    window of calls. Hooks are called as hook(method, seconds) after each call.
+    Only calls made by the user are recorded: methods that other methods call
+    internally (to() from tocuda(), for instance) count towards their caller.
+    """
+    __slots__ = ["window", "counts", "totals", "samples", "hooks", "active"]
+
+    def __init__(self, window: int = 1024) -> None:
+        self.window = window
+        self.counts = {}
+        self.totals = {}
+        self.samples = {}
+        self.hooks = []
+        self.active = threading.local()  # per thread: number of instrumented calls in progress
+
+    def enter(self) -> bool:
+        """Start timing a call; True if it is the outermost one in progress on this thread."""
+        active = self.active
+        depth = getattr(active, "depth", 0)
+        active.depth = depth + 1
+        return depth == 0
+
+    def leave(self, method: str, seconds: float, outermost: bool) -> None:
+        self.active.depth -= 1
+        if outermost:
+            self.record(method, seconds)
+
+    def record(self, method: str, seconds: float) -> None:
+        samples = self.samples.get(method)
+        if samples is None:
+            samples = self.samples[method] = collections.deque(maxlen=self.window)
+            self.counts[method] = 0
+            self.totals[method] = 0.0
+        self.counts[method] += 1
+        self.totals[method] += seconds
+        samples.append(seconds)
+        for hook in self.hooks:
+            hook(method, seconds)
+
+    def add_hook(self, hook: Callable[[str, float], None]) -> None:
+        self.hooks.append(hook)
+
+    def reset(self) -> None:
+        self.counts.clear()
+        self.totals.clear()
+        self.samples.clear()
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        """Per method: calls, total and mean seconds, and p50/p90/p99 over the recent window."""
+        report = {}
+        for method, samples in self.samples.items():
+            ordered = sorted(samples)
+            last = len(ordered) - 1
+            report[method] = {
+                "calls": self.counts[method],
+                "total": self.totals[method],
+                "mean": self.totals[method] / self.counts[method],
+                **{f"p{q}": ordered[min(last, int(q / 100 * len(ordered)))] for q in (50, 90, 99)},
+            }
+        return report
+
+class _StatePickler(ForkingPickler):
+    """Pickles CPU tensors by the name of their shared-memory segment.
+
+    Unlike torch's own reduction, which hands over a single reference that
+    the first unpickler consumes, a name can be opened by any number of
+    processes, each holding and dropping its own reference.
+    """
+
+    def __init__(self, file: Any, storages: List[Any]) -> None:
+        super().__init__(file)
+        self.storages = storages
+
+    def persistent_id(self, obj: Any) -> Any:
+        if not _is_tensor(obj) or obj.device.type != "cpu":
+            return None
+        storage = obj.untyped_storage()
+        manager, handle, size = storage._share_filename_cpu_()
+        self.storages.append(storage)
+        return (manager, handle, size, obj.dtype, obj.storage_offset(), tuple(obj.shape), obj.stride(), obj.requires_grad)
+
+class _StateUnpickler(pickle.Unpickler):
+    def persistent_load(self, pid: Any) -> Any:
+        manager, handle, size, dtype, offset, shape, stride, requires_grad = pid
+        storage = torch.UntypedStorage._new_shared_filename_cpu(manager, handle, size)
+        return torch.empty(0, dtype=dtype).set_(storage, offset, shape, stride).requires_grad_(requires_grad)
+
+class SharedStore:
+    """Publication channel of a shared Mangrove: a pickled state file and a memory-mapped generation counter.
+
+    Tensors in the state are pickled as shared-memory segment names, so
+    attaching processes map the owner's storage instead of copying it. The
+    owner keeps the storages of the latest publication alive, so its names
+    stay valid even after the variables are reassigned.
+    """
+    __slots__ = ["path", "owner", "seen", "control", "retained", "finalizer"]
+
+    def __init__(self, path: str, owner: bool) -> None:
+        self.path = path
+        self.owner = owner
+        self.seen = 0
+        control = os.path.join(path, "control")
+        if owner:
+            with open(control, "wb") as f:
+                f.write(bytes(8))
+        with open(control, "r+b") as f:
+            self.control = mmap.mmap(f.fileno(), 8)
+        self.retained = []
+        self.finalizer = None
+
+    def generation(self) -> int:
+        return struct.unpack_from("<Q", self.control, 0)[0]
+
+    def publish(self, state: Dict[str, Any]) -> None:
+        self.seen += 1
+        state["generation"] = self.seen
+        staging = os.path.join(self.path, "state.tmp")
+        storages = []
+        with open(staging, "wb") as f:
+            _StatePickler(f, storages).dump(state)
+        os.replace(staging, os.path.join(self.path, "state"))
+        struct.pack_into("<Q", self.control, 0, self.seen)
+        self.retained = storages
+
+    def sync(self, mangrove: "Mangrove") -> None:
+        if self.owner or self.generation() == self.seen:
+            return
+        with open(os.path.join(self.path, "state"), "rb") as f:
+            state = _StateUnpickler(f).load()
+        mangrove.depths = state["depths"]
+        mangrove.data = state["data"]
+        mangrove.types = state["types"]
+        mangrove.levels = state["levels"]
+        mangrove.inosculations = state["inosculations"]
+        mangrove.groups = {}
+        for seq, (name, depth) in enumerate(mangrove.levels.items()):
+            mangrove._regroup(name, mangrove.types[name], None, depth, seq)
+        mangrove.arenas = {}
+        mangrove.frozen = None
+        if mangrove.memo is not None:
+            mangrove.memo.clear()
+        self.seen = state["generation"]
+
+class UprootCache:
+    """LRU cache of uproot results, stamped with the versions of the (depth, type) groups they were built from.
+
+    A version is bumped whenever a variable of that group is added, pushed,
+    shifted, reassigned or moved, so a cached result is reused exactly until
+    one of its groups changes.
+    """
+    __slots__ = ["size", "entries", "versions", "hits", "misses"]
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.entries = collections.OrderedDict()  # key -> (stamp, result)
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def bump(self, depth: int, data_type: Type) -> None:
+        pair = (depth, data_type)
+        self.versions[pair] = self.versions.get(pair, 0) + 1
+
+    def _stamp(self, key: Tuple[Tuple[int, Type], ...]) -> Tuple[int, ...]:
+        return tuple(self.versions.get(pair, 0) for pair in key)
+
+    def get(self, key: Tuple[Tuple[int, Type], ...]) -> Optional[List[List[Tuple[str, Any]]]]:
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == self._stamp(key):
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def put(self, key: Tuple[Tuple[int, Type], ...], result: List[List[Tuple[str, Any]]]) -> None:
+        self.entries[key] = (self._stamp(key), result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def report(self) -> Dict[str, int]:
+        return {"size": self.size, "entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+class Spilled:
+    """Stand-in for a tensor evicted to disk by a memory budget."""
+    __slots__ = ["path", "dtype", "shape", "nbytes"]
+
+    def __init__(self, path: str, dtype: torch.dtype, shape: torch.Size, nbytes: int) -> None:
+        self.path = path
+        self.dtype = dtype
+        self.shape = shape
+        self.nbytes = nbytes
+
+    def load(self) -> torch.Tensor:
+        """Map the spilled bytes back as a tensor; pages are read on first touch."""
+        return torch.from_file(self.path, shared=False, size=self.shape.numel(), dtype=self.dtype).view(self.shape)
+
+class Tiering:
+    """Memory budget of a Mangrove: LRU accounting of resident CPU tensors and their spill files.
+
+    When resident bytes exceed the budget, tensors are evicted from the
+    lowest-priority depths first and least recently used first within them.
+    Arena depths are never evicted. Changes to the spill files are made
+    under lock, which readers on other threads (prefetch) take to load one.
+    """
+    __slots__ = ["budget", "priorities", "directory", "resident", "bytes", "spilled", "mapped", "evictions", "reloads", "counter", "finalizer", "lock"]
+
+    def __init__(self, budget: int, priorities: Dict[int, int], directory: str) -> None:
+        self.budget = budget
+        self.priorities = priorities
+        self.directory = directory
+        self.resident = collections.OrderedDict()  # name -> nbytes, least recently used first
+        self.bytes = 0
+        self.spilled = {}  # name -> spill file of a variable currently on disk
+        self.mapped = {}  # name -> spill file still backing a reloaded tensor
+        self.evictions = 0
+        self.reloads = 0
+        self.counter = 0
+        self.finalizer = None
+        self.lock = threading.Lock()
+
+    def _forget(self, name: str) -> None:
+        self.bytes -= self.resident.pop(name, 0)
+        for files in (self.spilled, self.mapped):
+            path = files.pop(name, None)
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+    def place(self, mangrove: "Mangrove", name: str) -> None:
+        """Account for a value just stored under name."""
+        self._forget(name)
+        value = mangrove.data[name]
+        if _is_tensor(value) and value.device.type == "cpu" and value.nbytes:
+            self.resident[name] = value.nbytes
+            self.bytes += value.nbytes
+
+    def reloaded(self, mangrove: "Mangrove", name: str) -> None:
+        """Account for a spilled tensor just stored back under name; the caller enforces the budget."""
+        self.reloads += 1
+        path = self.spilled.pop(name)
+        self.place(mangrove, name)
+        self.mapped[name] = path
+
+    def evict(self, mangrove: "Mangrove", name: str) -> None:
+        value = mangrove.data[name].detach().contiguous()
+        self._forget(name)
+        self.counter += 1
+        path = os.path.join(self.directory, f"{self.counter}.bin")
+        with open(path, "wb") as f:
+            f.truncate(value.nbytes)
+        out = torch.from_file(path, shared=True, size=value.nbytes, dtype=torch.uint8)
+        out.copy_(value.reshape(-1).view(torch.uint8))
+        del out
+        mangrove._own("data")[name] = Spilled(path, value.dtype, value.shape, value.nbytes)
+        self.spilled[name] = path
+        self.evictions += 1
+
+    def enforce(self, mangrove: "Mangrove", keep: Optional[str] = None) -> None:
+        if self.bytes <= self.budget:
+            return
+        levels, arenas = mangrove.levels, mangrove.arenas
+        for priority in sorted({self.priorities.get(levels[name], 0) for name in self.resident}):
+            for name in list(self.resident):
+                if self.bytes <= self.budget:
+                    return
+                depth = levels[name]
+                if name != keep and depth not in arenas and self.priorities.get(depth, 0) == priority:
+                    self.evict(mangrove, name)
+
+    def report(self) -> Dict[str, int]:
+        return {"budget": self.budget, "resident": self.bytes, "spilled": len(self.spilled), "evictions": self.evictions, "reloads": self.reloads}
+
+class LazyUproot:
+    """Cartesian product of an inosculation, produced one combination at a time.
+
+    Values are fetched with read(name), Mangrove._value unless given.
+    """
+    __slots__ = ["mangrove", "names", "sizes", "read"]
+
+    def __init__(self, mangrove: "Mangrove", names: List[List[str]], read: Optional[Callable[[str], Any]] = None) -> None:
+        self.mangrove = mangrove
+        self.names = names
+        self.sizes = [len(group) for group in names]
+        self.read = read if read is not None else mangrove._value
+
+    def __len__(self) -> int:
+        total = 1 if self.sizes else 0
+        for size in self.sizes:
+            total *= size
+        return total
+
+    def _combination(self, positions: List[int]) -> Tuple[Tuple[str, Any], ...]:
+        value = self.read
+        return tuple((group[p], value(group[p])) for group, p in zip(self.names, positions))
+
+    def _positions(self, i: int) -> List[int]:
+        positions = [0] * len(self.sizes)
+        for d in range(len(self.sizes) - 1, -1, -1):
+            i, positions[d] = divmod(i, self.sizes[d])
+        return positions
+
+    def _walk(self, start: int, stop: int) -> Iterator[Tuple[Tuple[str, Any], ...]]:
+        if start >= stop:
+            return
+        positions = self._positions(start)
+        for _ in range(start, stop):
+            yield self._combination(positions)
+            for d in range(len(self.sizes) - 1, -1, -1):
+                positions[d] += 1
+                if positions[d] < self.sizes[d]:
+                    break
+                positions[d] = 0
+
+    def __getitem__(self, i: int) -> Tuple[Tuple[str, Any], ...]:
+        total = len(self)
+        if i < 0:
+            i += total
+        if not 0 <= i < total:
+            raise IndexError(f"Combination index {i} out of range for {total} combinations.")
+        return self._combination(self._positions(i))
+
+    def __iter__(self) -> Iterator[Tuple[Tuple[str, Any], ...]]:
+        return self._walk(0, len(self))
+
+    def batches(self, k: int, start: int = 0) -> Iterator[List[Tuple[Tuple[str, Any], ...]]]:
+        """Yield lists of at most k consecutive combinations, beginning at index start."""
+        if k < 1:
+            raise ValueError("Batch size must be at least 1.")
+        total = len(self)
+        walk = self._walk(start, total)
+        for offset in range(start, total, k):
+            yield [next(walk) for _ in range(min(k, total - offset))]
+
+    def _stack(self, group: List[str]) -> torch.Tensor:
+        values = [self.read(name) for name in group]
+        if all(isinstance(v, torch.Tensor) for v in values):
+            if len({v.shape for v in values}) > 1:
+                self.mangrove._raise_exception("Tensors in an inosculated group must share a shape to be collated.")
+            return torch.stack(values)
+        if all(isinstance(v, (int, float)) for v in values):
+            return torch.tensor(values)
+        self.mangrove._raise_exception("Only tensor, int and float groups can be collated.")
+
+    def collate(self, k: int, start: int = 0) -> Iterator[Tuple[List[torch.Tensor], List[List[str]]]]:
+        """Yield chunks of k combinations as one batched tensor per depth plus the matching names.
+
+        Each group is stacked once into a buffer; every chunk is then a single
+        index_select per group over that buffer.
+        """
+        if k < 1:
+            raise ValueError("Batch size must be at least 1.")
+        total = len(self)
+        if start >= total:
+            return
+        buffers = [self._stack(group) for group in self.names]
+        for offset in range(start, total, k):
+            flat = torch.arange(offset, min(offset + k, total))
+            tensors, names = [], []
+            for d in range(len(self.sizes) - 1, -1, -1):
+                flat, idx = torch.div(flat, self.sizes[d], rounding_mode="floor"), flat % self.sizes[d]
+                tensors.append(buffers[d].index_select(0, idx.to(buffers[d].device)))
+                group = self.names[d]
+                names.append([group[p] for p in idx.tolist()])
+            yield tensors[::-1], names[::-1]
+
+class Prefetcher:
+    """Assemble batches on a background thread, keeping up to `ahead` of them ready.
+
+    Usable as a plain iterator, with `async for`, and as a (async) context
+    manager; close() stops the producer early, and so does dropping the
+    Prefetcher, since the thread holds no reference to it. Errors raised
+    while building a batch are re-raised in the consumer.
+    """
+    __slots__ = ["queue", "stop", "thread", "finished", "finalizer", "__weakref__"]
+    _DONE = object()
+    _POLL = 0.05  # seconds between checks of the stop flag while waiting on the queue
+
+    def __init__(self, source: Iterator[Any], ahead: int = 2) -> None:
+        if ahead < 1:
+            raise ValueError("Prefetch depth must be at least 1.")
+        self.queue = queue.Queue(maxsize=ahead)
+        self.stop = threading.Event()
+        self.finished = False
+        self.thread = threading.Thread(target=Prefetcher._fill, args=(source, self.queue, self.stop), daemon=True)
+        self.thread.start()
+        self.finalizer = weakref.finalize(self, self.stop.set)
+
+    @staticmethod
+    def _put(items: queue.Queue, stop: threading.Event, item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=Prefetcher._POLL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    @staticmethod
+    def _fill(source: Iterator[Any], items: queue.Queue, stop: threading.Event) -> None:
+        put = Prefetcher._put
+        try:
+            for batch in source:
+                if not put(items, stop, (True, batch)):
+                    return
+        except BaseException as error:
+            put(items, stop, (False, error))
+        put(items, stop, Prefetcher._DONE)
+
+    def _take(self) -> Any:
+        while not self.finished:
+            try:
+                item = self.queue.get(timeout=self._POLL)
+            except queue.Empty:
+                if self.stop.is_set():
+                    self.finished = True
+                continue
+            if item is self._DONE:
+                self.finished = True
+                return item
+            ok, payload = item
+            if not ok:
+                self.finished = True
+                raise payload
+            return payload
+        return self._DONE
+
+    def __iter__(self) -> "Prefetcher":
+        return self
+
+    def __next__(self) -> Any:
+        item = self._take()
+        if item is self._DONE:
+            raise StopIteration
+        return item
+
+    def __aiter__(self) -> "Prefetcher":
+        return self
+
+    async def __anext__(self) -> Any:
+        import asyncio
+        item = await asyncio.get_running_loop().run_in_executor(None, self._take)
+        if item is self._DONE:
+            raise StopAsyncIteration
+        return item
+
+    def close(self) -> None:
+        self.stop.set()
+        self.finished = True
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=self._POLL)
+            except queue.Empty:
+                pass
+        self.thread.join()
+
+    def __enter__(self) -> "Prefetcher":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    async def __aenter__(self) -> "Prefetcher":
+        return self
+
+    async def __aexit__(self, *exc: Any) -> None:
+        import asyncio
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+class Pool:
+    """Free list of Mangroves for short-lived, per-request stores.
+
+    acquire() hands out an empty instance configured with depths and
+    release() resets it and keeps it for the next caller; beyond size idle
+    instances, released ones are left to the garbage collector. Only
+    instances currently handed out by this pool can be released.
+    """
+    __slots__ = ["size", "depths", "idle", "lent", "lock", "created", "reused"]
+
+    def __init__(self, size: int, depths: Optional[Dict[int, List[Type]]] = None) -> None:
+        if depths and 0 in depths:
+            raise Exception("MangroveException: Depth 0 is pre-configured and cannot be modified.")
+        self.size = size
+        self.depths = {depth: list(types) for depth, types in (depths or {}).items()}
+        self.idle = []
+        self.lent = {}  # id -> weak reference of the instances handed out and not yet released
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self) -> "Mangrove":
+        with self.lock:
+            if self.idle:
+                self.reused += 1
+                mangrove = self.idle.pop()
+                self._lend(mangrove)
+                return mangrove
+            self.created += 1
+        mangrove = Mangrove()
+        for depth, types in self.depths.items():
+            mangrove.config(depth, list(types))
+        with self.lock:
+            self._lend(mangrove)
+        return mangrove
+
+    def _lend(self, mangrove: "Mangrove") -> None:
+        """Record mangrove as handed out; the entry removes itself if the caller drops it without releasing."""
+        lent, key = self.lent, id(mangrove)
+
+        def dropped(ref: weakref.ref) -> None:
+            # Runs during garbage collection, possibly while the lock is held, so it does not take it
+            if lent.get(key) is ref:
+                lent.pop(key, None)
+
+        lent[key] = weakref.ref(mangrove, dropped)
+
+    def release(self, mangrove: "Mangrove") -> None:
+        with self.lock:
+            lent = self.lent.pop(id(mangrove), None)
+            if lent is None or lent() is not mangrove:
+                raise Exception("MangroveException: This Mangrove is not checked out of the pool; was it released twice?")
+        mangrove.reset(self.depths)
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(mangrove)
+
+    @contextlib.contextmanager
+    def borrow(self) -> Iterator["Mangrove"]:
+        """acquire() for the duration of a with block, released on exit."""
+        mangrove = self.acquire()
+        try:
+            yield mangrove
+        finally:
+            self.release(mangrove)
+
+    def report(self) -> Dict[str, int]:
+        return {"size": self.size, "idle": len(self.idle), "created": self.created, "reused": self.reused}
 
 class Mangrove:
-    __slots__ = ["depths", "data", "types", "levels", "inosculations"]
+    __slots__ = ["depths", "data", "types", "levels", "inosculations", "groups", "arenas", "lock", "generation", "frozen", "shared", "stats", "tiering", "dirty", "memo", "owned", "__weakref__"]
     _instances = weakref.WeakValueDictionary()  # WeakValueDictionary to keep track of instances
+    _slots = frozenset(__slots__)  # constant-time check in __setattr__
 
     def __init__(self) -> None:
         instance_id = id(self)
@@ -12,12 +688,62 @@ class Mangrove:
             raise Exception("MangroveException: Cannot reuse variable name for this instance unless deleted.")
         
         Mangrove._instances[instance_id] = self  # Register the new instance
-        
-        self.depths = {0: [int, float, str, torch.Tensor]}
-        self.data = {}
-        self.types = {}
-        self.levels = {}
-        self.inosculations = {}
+        self._clear()
+
+    def _clear(self, depths: Optional[Dict[int, List[Type]]] = None, reuse: bool = False) -> None:
+        """Set every piece of per-instance state to its initial value; shared by __init__ and reset().
+
+        With reuse the existing tables are emptied in place rather than
+        replaced, which is cheaper but only safe when no snapshot shares them.
+        """
+        init = object.__setattr__  # all slots, so skip the variable-assignment dispatch of __setattr__
+        configured = {0: _base_types()}
+        if depths:
+            for depth, types in depths.items():
+                configured[depth] = list(types)
+        init(self, "depths", configured)
+        if reuse:
+            for state in (self.data, self.types, self.levels, self.inosculations, self.groups, self.arenas, self.dirty):
+                state.clear()
+        else:
+            init(self, "data", {})
+            init(self, "types", {})
+            init(self, "levels", {})
+            init(self, "inosculations", {})
+            init(self, "groups", {})  # depth -> type -> ordered names, kept in step with levels/types
+            init(self, "arenas", {})  # depth -> (dtype, device) -> (flat buffer, [(name, offset, shape)]); None when stale
+            init(self, "dirty", {})  # names added, reassigned, pushed or shifted since the last checkpoint
+        init(self, "generation", 0)
+        # Switched on by concurrent() (lock, frozen, and owned: ids of the tables no published snapshot
+        # shares), share() or attach() (shared), instrument() (stats), budget() (tiering) and memoize()
+        # (memo); a reused instance only pays for the ones it turned on
+        for name in ("lock", "frozen", "owned", "shared", "stats", "tiering", "memo"):
+            if not reuse or getattr(self, name) is not None:
+                init(self, name, None)
+
+    def reset(self, depths: Optional[Dict[int, List[Type]]] = None) -> None:
+        """Drop every variable and setting, leaving the instance as if freshly constructed and configured with depths.
+
+        Much cheaper than building a new Mangrove, which is what Pool relies on.
+        """
+        if self.shared is not None:
+            self._raise_exception("Cannot reset a shared Mangrove: other processes may be attached to it.")
+        if depths and 0 in depths:
+            self._raise_exception("Depth 0 is pre-configured and cannot be modified.")
+        tiering = self.tiering
+        if tiering is not None:
+            with tiering.lock:
+                for name in list(tiering.spilled) + list(tiering.mapped):
+                    tiering._forget(name)
+                if tiering.finalizer is not None:
+                    tiering.finalizer()
+        # In concurrent mode published snapshots share the tables, so they are replaced rather than emptied
+        self._clear(depths, reuse=self.lock is None)
+
+    @classmethod
+    def pool(cls, size: int = 64, depths: Optional[Dict[int, List[Type]]] = None) -> "Pool":
+        """A Pool recycling up to size idle instances, each handed out configured with depths."""
+        return Pool(size, depths)
 
     def deleter(self) -> None:
         """Remove the instance from the WeakValueDictionary."""
@@ -32,34 +758,224 @@ class Mangrove:
         """Raise an exception with a custom message."""
         raise Exception(f"MangroveException: {message}")
 
+    def _own(self, table: str) -> Any:
+        """A top-level table (data, types, levels, ...) that is safe to mutate in place.
+
+        In concurrent mode the published snapshot shares the tables, so the
+        first write to one after a snapshot is taken replaces it with a copy.
+        """
+        value = getattr(self, table)
+        owned = self.owned
+        if owned is None or id(value) in owned:
+            return value
+        value = value.copy()
+        object.__setattr__(self, table, value)
+        owned.add(id(value))
+        return value
+
+    def _own_item(self, container: Dict[Any, Any], key: Any) -> Dict[Any, Any]:
+        """container[key], a dict created if missing, made safe to mutate like _own; container must already be owned."""
+        value = container.get(key)
+        owned = self.owned
+        if value is None:
+            value = container[key] = {}
+        elif owned is None or id(value) in owned:
+            return value
+        else:
+            value = container[key] = value.copy()
+        if owned is not None:
+            owned.add(id(value))
+        return value
+
+    def _regroup(self, name: str, data_type: Type, old_depth: Optional[int], new_depth: int, seq: Optional[int] = None) -> None:
+        """Move a variable between (depth, type) groups of the secondary index.
+
+        Groups map names to their insertion sequence (their position in data)
+        and stay ordered by it, so selections follow insertion order; a new
+        variable (old_depth None) passes its seq.
+        """
+        if self.owned is None:
+            groups = self.groups
+            if old_depth is not None:
+                by_type = groups[old_depth]
+                seq = by_type[data_type].pop(name)
+                if not by_type[data_type]:
+                    del by_type[data_type]
+            group = groups.setdefault(new_depth, {}).setdefault(data_type, {})
+        else:
+            # Concurrent mode: copy only the groups on the path being changed
+            groups = self._own("groups")
+            if old_depth is not None:
+                by_type = self._own_item(groups, old_depth)
+                names = self._own_item(by_type, data_type)
+                seq = names.pop(name)
+                if not names:
+                    del by_type[data_type]
+            group = self._own_item(self._own_item(groups, new_depth), data_type)
+        _insert(group, name, seq)
+
+    def _value(self, name: str) -> Any:
+        """Value of a variable, reloading it if it was spilled and marking it recently used under a budget."""
+        tiering = self.tiering
+        if tiering is None:
+            value = self.data[name]
+            return value.load() if type(value) is Spilled else value
+        if self.lock is None:
+            return self._touch(name, tiering)
+        # Reloads store the tensor and may evict others: in concurrent mode that is a write
+        with self.lock:
+            return self._touch(name, tiering)
+
+    def _touch(self, name: str, tiering: "Tiering") -> Any:
+        with tiering.lock:
+            value = self.data[name]
+            if type(value) is Spilled:
+                value = value.load()
+                self._own("data")[name] = value
+                tiering.reloaded(self, name)
+                tiering.enforce(self, keep=name)
+                if self.lock is not None:
+                    self.generation += 1
+            elif name in tiering.resident:
+                tiering.resident.move_to_end(name)
+        return value
+
+    def _peek(self, name: str) -> Any:
+        """Value of a variable without touching budget bookkeeping."""
+        value = self.data[name]
+        if type(value) is not Spilled:
+            return value
+        tiering = self.tiering
+        if tiering is None:
+            return value.load()
+        # Another thread may reload it and drop its spill file in the meantime
+        with tiering.lock:
+            value = self.data[name]
+            return value.load() if type(value) is Spilled else value
+
+    def _allows(self, depth: int, data_type: Type) -> bool:
+        """Whether data_type may be stored at a configured depth; torch.Tensor joins depth 0 once torch is imported."""
+        types = self.depths[depth]
+        if data_type in types:
+            return True
+        if depth == 0 and data_type is _tensor_type():
+            self._own("depths")[0] = types + [data_type]
+            return True
+        return False
+
+    def _bump(self, depth: int, data_type: Type) -> None:
+        if self.memo is not None:
+            self.memo.bump(depth, data_type)
+
+    def _placed(self, names: Iterable[str]) -> None:
+        tiering = self.tiering
+        if tiering is not None:
+            with tiering.lock:
+                for name in names:
+                    tiering.place(self, name)
+                tiering.enforce(self)
+
+    def _select(self, depth: Optional[int] = None, data_type: Optional[Type] = None) -> List[str]:
+        """Names matching the optional depth and type filters, read from the secondary index."""
+        if depth is None and data_type is None:
+            return list(self.data)
+        if depth is not None:
+            by_type = self.groups.get(depth, {})
+            if data_type is not None:
+                return list(by_type.get(data_type, ()))
+            groups = list(by_type.values())
+        else:
+            groups = [by_type[data_type] for by_type in self.groups.values() if data_type in by_type]
+        if len(groups) == 1:
+            return list(groups[0])
+        # Each group is ordered by insertion sequence: groups added one after the other
+        # are simply concatenated, interleaved ones are merged by sequence
+        groups.sort(key=_first_seq)
+        if all(next(reversed(a.values())) < _first_seq(b) for a, b in zip(groups, groups[1:])):
+            names = []
+            for group in groups:
+                names.extend(group)
+            return names
+        merged = {}
+        for group in groups:
+            merged.update(group)
+        return sorted(merged, key=merged.__getitem__)
+
+    @_writes
     def config(self, depth: int, types: List[Type]) -> None:
         if depth == 0:
             self._raise_exception("Depth 0 is pre-configured and cannot be modified.")
-        self.depths[depth] = types
+        self._own("depths")[depth] = types
 
+    @_writes
     def add_data(self, depth: int, data_type: Type, var: List[str], value: Optional[List[Any]] = None) -> None:
-        if len(var) != len(value):
+        if value is not None and len(var) != len(value):
             self._raise_exception("Length of variable names and values must match.")
 
         if not self.depths.get(depth):
             self._raise_exception(f"Depth {depth} not configured. Please configure the depth first.")
         
-        if data_type not in self.depths[depth]:
+        if not self._allows(depth, data_type):
             self._raise_exception(f"Type {data_type} is not allowed at depth {depth}.")
 
+        data, types, levels = self._own("data"), self._own("types"), self._own("levels")
         for i, v in enumerate(var):
-            if v in self.data:
+            if v in data:
                 self._raise_exception(f"Variable name {v} is already in use.")
-            self.data[v] = value[i] if value else None
-            self.types[v] = data_type
-            self.levels[v] = depth
+            data[v] = value[i] if value else None
+            types[v] = data_type
+            levels[v] = depth
+            self._regroup(v, data_type, None, depth, len(data) - 1)
+            self.dirty[v] = None
+        self._stale_arena(depth)
+        self._bump(depth, data_type)
+        self._placed(var)
+
+    @_writes
+    def add_many(self, records: Iterable[Tuple[int, Type, str, Any]]) -> None:
+        """Add (depth, type, name, value) records in one batch: everything is validated before anything is stored."""
+        records = list(records)
+        allowed = {}
+        seen = set()
+        for depth, data_type, name, _ in records:
+            types = allowed.get(depth)
+            if types is None:
+                if not self.depths.get(depth):
+                    self._raise_exception(f"Depth {depth} not configured. Please configure the depth first.")
+                types = allowed[depth] = set(self.depths[depth])
+            if data_type not in types:
+                if not self._allows(depth, data_type):
+                    self._raise_exception(f"Type {data_type} is not allowed at depth {depth}.")
+                types.add(data_type)
+            if name in seen or name in self.data:
+                self._raise_exception(f"Variable name {name} is already in use.")
+            seen.add(name)
+
+        data, types, levels = self._own("data"), self._own("types"), self._own("levels")
+        groups = self._own("groups")
+        group_of = {}
+        for depth, data_type, name, value in records:
+            data[name] = value
+            types[name] = data_type
+            levels[name] = depth
+            self.dirty[name] = None
+            group = group_of.get((depth, data_type))
+            if group is None:
+                group = group_of[(depth, data_type)] = self._own_item(self._own_item(groups, depth), data_type)
+            group[name] = len(data) - 1
+        for depth in allowed:
+            self._stale_arena(depth)
+        for depth, data_type in group_of:
+            self._bump(depth, data_type)
+        self._placed(seen)
 
+    @_writes
     def inosc(self, depth_variable_pairs: List[Tuple[int, Type]]) -> Tuple[Tuple[int, Type], ...]:
         counts = {}
         for depth, var_type in depth_variable_pairs:
             if depth not in self.depths:
                 self._raise_exception(f"Depth {depth} is not configured.")
-            if var_type not in self.depths[depth]:
+            if not self._allows(depth, var_type):
                 self._raise_exception(f"Type {var_type} is not allowed at depth {depth}.")
             counts[depth] = counts.get(depth, 0) + 1
 
@@ -67,25 +983,56 @@ class Mangrove:
             self._raise_exception("The number of variables in each depth must match for inosculation.")
         
         inosc_key = tuple(sorted(depth_variable_pairs))
-        self.inosculations[inosc_key] = True
+        self._own("inosculations")[inosc_key] = True
         return inosc_key
 
+    @_reads
     def uproot(self, cojoin: Tuple[Tuple[int, Type], ...]) -> List[List[Tuple[str, Any]]]:
+        memo = self.memo
+        if memo is not None:
+            cached = memo.get(cojoin)
+            if cached is not None:
+                return cached
         cojoined_data = []
         for depth, var_type in cojoin:
-            var_names = [name for name, dtype in self.types.items() if dtype == var_type and self.levels[name] == depth]
-            var_values = [self.data[v] for v in var_names]
+            var_names = self._select(depth, var_type)
+            var_values = [self._value(v) for v in var_names]
 
             if not cojoined_data:
                 cojoined_data = [[(name, value)] for name, value in zip(var_names, var_values)]
             else:
                 cojoined_data = [existing + [(name, value)] for existing in cojoined_data for name, value in zip(var_names, var_values)]
 
+        if memo is not None:
+            memo.put(cojoin, cojoined_data)
         return cojoined_data
 
+    @_reads
+    def uproot_iter(self, cojoin: Tuple[Tuple[int, Type], ...]) -> LazyUproot:
+        """Lazy counterpart of uproot: same combinations and order, nothing materialised up front."""
+        return LazyUproot(self, [self._select(depth, var_type) for depth, var_type in cojoin])
+
+    @_reads
+    def prefetch(self, cojoin: Tuple[Tuple[int, Type], ...], k: int, ahead: int = 2, collate: bool = False) -> Prefetcher:
+        """Iterate uproot_iter(cojoin).batches(k), or .collate(k), with batches built ahead on a background thread.
+
+        The producer thread only peeks at values: reloading, LRU order and
+        eviction under a budget are left to the consumer's own reads.
+        """
+        lazy = LazyUproot(self, [self._select(depth, var_type) for depth, var_type in cojoin], read=self._peek)
+        return Prefetcher(lazy.collate(k) if collate else lazy.batches(k), ahead)
+
+    @_reads
     def summary(self) -> Dict[str, Union[Dict[str, Union[int, Type]], Dict[str, Type]]]:
         summary_dict = {'configured': {}, 'unconfigured (depth 0)': {}, 'inosculated': {}}
-        
+        inosculated = summary_dict['inosculated']
+
+        # (depth, type) -> keys containing it, each once, so every name is matched with one lookup
+        keys_of = {}
+        for inosc_key in self.inosculations:
+            for pair in inosc_key:
+                keys_of.setdefault(pair, {})[str(inosc_key)] = None
+
         for name, depth in self.levels.items():
             dtype = self.types[name]
             if depth == 0:
@@ -93,53 +1040,647 @@ class Mangrove:
             else:
                 summary_dict['configured'][name] = {"depth": depth, "type": dtype}
 
-            for inosc_key in self.inosculations:
-                if (depth, dtype) in inosc_key:
-                    summary_dict['inosculated'].setdefault(str(inosc_key), []).append(name)
+            for key in keys_of.get((depth, dtype), ()):
+                inosculated.setdefault(key, []).append(name)
 
         return summary_dict
 
     def __setattr__(self, name: str, value: Any) -> None:
-        if name in self.__slots__:
+        if name in Mangrove._slots:
             object.__setattr__(self, name, value)
+            return
+        dtype = self.types.get(name)
+        if not (dtype and isinstance(value, dtype)):
+            self._raise_exception(f"Value must be of type {dtype}.")
+        stats, lock = self.stats, self.lock
+        if stats is None and lock is None:
+            self._assign(name, value, dtype)
+            return
+        start = time.perf_counter()
+        if lock is None:
+            self._assign(name, value, dtype)
         else:
-            dtype = self.types.get(name)
-            if dtype and isinstance(value, dtype):
-                self.data[name] = value
-            else:
-                self._raise_exception(f"Value must be of type {dtype}.")
+            with lock:
+                self._assign(name, value, dtype)
+                self.generation += 1
+        if stats is not None:
+            stats.record("__setattr__", time.perf_counter() - start)
+
+    def _assign(self, name: str, value: Any, data_type: Type) -> None:
+        """Store a new value for an existing variable, updating only the features that are switched on."""
+        data = self.data if self.owned is None else self._own("data")
+        data[name] = value
+        self.dirty[name] = None
+        memo, arenas = self.memo, self.arenas
+        if memo is not None or arenas:
+            depth = self.levels[name]
+            if memo is not None:
+                memo.bump(depth, data_type)
+            if depth in arenas:
+                arenas[depth] = None
+        if self.tiering is not None:
+            self._placed((name,))
 
     def __getattr__(self, name: str) -> Any:
+        stats = self.stats
+        if stats is None and self.shared is None and self.tiering is None:
+            data = self.data
+            if name not in data:
+                self._raise_exception(f"No such attribute: {name}")
+            value = data[name]
+            return value.load() if type(value) is Spilled else value
+        start = time.perf_counter() if stats is not None else 0.0
+        if self.shared is not None:
+            self.shared.sync(self)
         if name in self.data:
-            return self.data[name]
+            value = self._value(name)
+            if stats is not None:
+                stats.record("__getattr__", time.perf_counter() - start)
+            return value
         self._raise_exception(f"No such attribute: {name}")
 
+    @_reads
     def var(self, depth: Optional[int] = None, data_type: Optional[Type] = None) -> List[str]:
-        return [name for name in self.data.keys() if (depth is None or depth == self.levels.get(name, None)) and (data_type is None or data_type == self.types.get(name, None))]
+        return self._select(depth, data_type)
 
+    @_reads
     def index(self, depth: Optional[int] = None, data_type: Optional[Type] = None) -> Dict[str, Any]:
-        return {name: value for name, value in self.data.items() if (depth is None or depth == self.levels.get(name, None)) and (data_type is None or data_type == self.types.get(name, None))}
+        return {name: self._value(name) for name in self._select(depth, data_type)}
 
+    @_writes
     def push(self, depth: int, var_name: str) -> None:
         if self.levels.get(var_name, None) != 0:
             self._raise_exception(f"{var_name} is not at depth 0. Cannot push.")
-        self.levels[var_name] = depth
+        self._own("levels")[var_name] = depth
+        self._regroup(var_name, self.types[var_name], 0, depth)
+        self.dirty[var_name] = None
+        self._bump(0, self.types[var_name])
+        self._bump(depth, self.types[var_name])
+        self._stale_arena(0)
+        self._stale_arena(depth)
 
+    @_writes
     def tocuda(self, depth: Optional[int] = None, data_type: Optional[Type] = None) -> None:
         if torch.cuda.is_available():
-            for name in self.data.keys():
-                if (depth is None or depth == self.levels.get(name, None)) and (data_type is None or data_type == self.types.get(name, None)):
-                    value = self.data[name]
-                    if isinstance(value, torch.Tensor):
-                        self.data[name] = value.cuda()
+            self.to("cuda", depth=depth, data_type=data_type)
         else:
             self._raise_exception("A CUDA-enabled GPU is not available on this device.")
 
+    @_writes
+    def to(self, device: Optional[Union[str, torch.device]] = None, dtype: Optional[torch.dtype] = None,
+           depth: Optional[int] = None, data_type: Optional[Type] = None, non_blocking: bool = False,
+           pin_memory: bool = False, max_workers: int = 4) -> int:
+        """Move and/or cast the selected tensors and return the number of bytes written.
+
+        dtype only applies to tensors of the same kind (floating point or not), so
+        a float32 -> bfloat16 cast leaves integer tensors alone. pin_memory pins
+        CPU-resident results and is a no-op without CUDA. Copies are grouped by
+        source placement and run on a thread pool; arena depths move as whole buffers.
+        """
+        device = torch.device(device) if device is not None else None
+        pin = pin_memory and torch.cuda.is_available()
+
+        def convert(value: torch.Tensor) -> torch.Tensor:
+            target_dtype = dtype if dtype is not None and value.is_floating_point() == dtype.is_floating_point else value.dtype
+            target_device = device if device is not None else value.device
+            if pin and value.device.type == "cpu" and target_device.type != "cpu" and not value.is_pinned():
+                value = value.pin_memory()
+            moved = value.to(device=target_device, dtype=target_dtype, non_blocking=non_blocking)
+            if pin and moved.device.type == "cpu" and not moved.is_pinned():
+                moved = moved.pin_memory()
+            return moved
+
+        moved_bytes = 0
+        arena_depths = [] if data_type not in (None, torch.Tensor) else [d for d in ([depth] if depth is not None else list(self.arenas)) if d in self.arenas]
+        arena_moves = []
+
+        def convert_buffer(buffer: torch.Tensor) -> torch.Tensor:
+            moved = convert(buffer)
+            if moved is not buffer:
+                arena_moves.append(moved.nbytes)
+            return moved
+
+        for d in arena_depths:
+            self.arena_map(d, convert_buffer)
+        moved_bytes += sum(arena_moves)
+
+        batches = {}
+        for name in self._select(depth, data_type):
+            value = self._peek(name)
+            if isinstance(value, torch.Tensor) and self.levels[name] not in arena_depths:
+                batches.setdefault((value.device, value.dtype), []).append(name)
+        jobs = []
+        for names in batches.values():
+            step = -(-len(names) // max_workers)
+            jobs.extend(names[i:i + step] for i in range(0, len(names), step))
+        if not jobs:
+            return moved_bytes
+
+        def run(names: List[str]) -> List[Tuple[str, torch.Tensor, torch.Tensor]]:
+            # Spilled tensors are mapped back to be converted; unchanged ones stay on disk
+            values = [self._peek(name) for name in names]
+            return [(name, value, convert(value)) for name, value in zip(names, values)]
+
+        placed = []
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for results in pool.map(run, jobs):
+                for name, value, moved in results:
+                    if moved is not value:
+                        moved_bytes += moved.nbytes
+                        self._own("data")[name] = moved
+                        self.dirty[name] = None
+                        self._bump(self.levels[name], self.types[name])
+                        placed.append(name)
+        self._placed(placed)
+        return moved_bytes
+
+    @_writes
     def shift(self, to: int, variable_name: str) -> None:
         data_type = self.types.get(variable_name, None)
         if data_type is None:
             self._raise_exception(f"Variable {variable_name} does not exist.")
         if to == 0 or data_type in self.depths.get(to, []):
-            self.levels[variable_name] = to
+            self._regroup(variable_name, data_type, self.levels[variable_name], to)
+            self.dirty[variable_name] = None
+            self._bump(self.levels[variable_name], data_type)
+            self._bump(to, data_type)
+            self._stale_arena(self.levels[variable_name])
+            self._stale_arena(to)
+            self._own("levels")[variable_name] = to
         else:
             self._raise_exception(f"Type {data_type} is not allowed at depth {to}.")
+
+    def concurrent(self, enabled: bool = True) -> None:
+        """Switch concurrent mode on or off.
+
+        In concurrent mode every mutation runs under one lock and bumps the
+        generation, and queries (var, index, uproot, uproot_iter, summary, save)
+        read from a snapshot of the generation they started in, so readers never
+        see a half-applied add, push or shift. Snapshots share the tables with
+        the instance: a writer copies a table (or a single group of the index)
+        the first time it changes it after a snapshot was taken, so readers
+        copy nothing and writes between reads copy nothing either.
+        """
+        self.lock = threading.RLock() if enabled else None
+        self.frozen = None
+        self.owned = set() if enabled else None
+
+    def snapshot(self) -> "Mangrove":
+        """A read-only view of the current generation; shared by all readers until the next mutation.
+
+        Publishing one takes the lock for a constant-time step: the snapshot
+        takes references to the current tables, and every table becomes
+        copy-on-write for the writer (see concurrent()).
+        """
+        if self.lock is None:
+            return self
+        frozen = self.frozen
+        if frozen is not None and frozen.generation == self.generation:
+            return frozen
+        with self.lock:
+            frozen = self.frozen
+            if frozen is None or frozen.generation != self.generation:
+                frozen = object.__new__(Mangrove)
+                frozen.depths = self.depths
+                frozen.data = self.data
+                frozen.types = self.types
+                frozen.levels = self.levels
+                frozen.inosculations = self.inosculations
+                frozen.groups = self.groups
+                frozen.arenas = {}
+                frozen.lock = None
+                frozen.generation = self.generation
+                frozen.frozen = None
+                frozen.shared = None
+                frozen.stats = None
+                frozen.tiering = None
+                frozen.dirty = {}
+                frozen.memo = None
+                frozen.owned = None
+                self.owned = set()
+                self.frozen = frozen
+        return frozen
+
+    def instrument(self, enabled: bool = True, window: int = 1024, hook: Optional[Callable[[str, float], None]] = None) -> Optional[CallStats]:
+        """Start (or stop) recording call counts and latencies of the public methods; returns the CallStats."""
+        self.stats = CallStats(window) if enabled else None
+        if hook is not None and self.stats is not None:
+            self.stats.add_hook(hook)
+        return self.stats
+
+    def memoize(self, size: Optional[int] = 32) -> Optional[UprootCache]:
+        """Cache up to size uproot results (None or 0 turns caching off); returns the UprootCache for its hit/miss counts.
+
+        Cached results are shared between callers and must not be mutated.
+        """
+        self.memo = UprootCache(size) if size else None
+        return self.memo
+
+    @_reads
+    def memory(self) -> Dict[int, Dict[Type, Dict[str, Any]]]:
+        """Variable counts, tensor elements, bytes and bytes per device, broken down by depth and type."""
+        accounting = {}
+        for depth, by_type in self.groups.items():
+            for data_type, names in by_type.items():
+                entry = {"variables": len(names), "tensors": 0, "numel": 0, "nbytes": 0, "devices": {}}
+                for name in names:
+                    value = self._peek(name)
+                    if _is_tensor(value):
+                        entry["tensors"] += 1
+                        entry["numel"] += value.numel()
+                        entry["nbytes"] += value.nbytes
+                        device = str(value.device)
+                        entry["devices"][device] = entry["devices"].get(device, 0) + value.nbytes
+                accounting.setdefault(depth, {})[data_type] = entry
+        return accounting
+
+    @_writes
+    def budget(self, max_bytes: Optional[int], priorities: Optional[Dict[int, int]] = None, spill_dir: Optional[str] = None) -> None:
+        """Cap the bytes of resident CPU tensors, spilling the coldest ones to disk; None lifts the cap.
+
+        priorities maps depth to importance (default 0); lower-priority depths
+        are evicted first, least recently used first within a depth. Spilled
+        tensors are memory-mapped back the next time they are read.
+        """
+        tiering = self.tiering
+        if tiering is not None:
+            with tiering.lock:
+                data = self._own("data")
+                for name in tiering.spilled:
+                    data[name] = data[name].load().clone()
+                for name in list(tiering.mapped):
+                    data[name] = data[name].clone()
+                for name in list(tiering.spilled) + list(tiering.mapped):
+                    tiering._forget(name)
+                if tiering.finalizer is not None:
+                    tiering.finalizer()
+                self.tiering = None
+        if max_bytes is None:
+            return
+        if spill_dir is None:
+            directory = tempfile.mkdtemp(prefix="mangrove-spill-")
+            tiering = Tiering(max_bytes, dict(priorities or {}), directory)
+            tiering.finalizer = weakref.finalize(self, shutil.rmtree, directory, True)
+        else:
+            os.makedirs(spill_dir, exist_ok=True)
+            tiering = Tiering(max_bytes, dict(priorities or {}), spill_dir)
+        self.tiering = tiering
+        self._placed(self.data)
+
+    def share(self, path: Optional[str] = None) -> str:
+        """Move every tensor into shared memory and publish the store for other processes; returns the path to attach to.
+
+        This switches torch to the file_system sharing strategy, so any number
+        of processes can map the same tensors. In-place tensor updates are seen
+        by attached processes at once; new or reassigned variables are seen
+        after publish().
+        """
+        import torch.multiprocessing
+        torch.multiprocessing.set_sharing_strategy("file_system")
+        if path is None:
+            path = tempfile.mkdtemp(prefix="mangrove-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+            store = SharedStore(path, owner=True)
+            store.finalizer = weakref.finalize(self, shutil.rmtree, path, True)
+        else:
+            os.makedirs(path, exist_ok=True)
+            store = SharedStore(path, owner=True)
+        self.shared = store
+        self.publish()
+        return path
+
+    @_writes
+    def publish(self) -> None:
+        """Make the current names, types, depths and values visible to attached processes."""
+        if self.shared is None or not self.shared.owner:
+            self._raise_exception("Only a Mangrove that called share() can publish.")
+        for value in self.data.values():
+            if isinstance(value, torch.Tensor) and not value.is_shared():
+                value.share_memory_()
+        self.shared.publish({"depths": self.depths, "data": self.data, "types": self.types,
+                             "levels": self.levels, "inosculations": self.inosculations})
+
+    @classmethod
+    def attach(cls, path: str) -> "Mangrove":
+        """Open a store shared by another process. It follows every publish() of the owner and is meant for reading."""
+        m = cls()
+        m.shared = SharedStore(path, owner=False)
+        m.shared.sync(m)
+        return m
+
+    def __reduce_ex__(self, protocol: int) -> Any:
+        if self.shared is not None:
+            return Mangrove.attach, (self.shared.path,)
+        return object.__reduce_ex__(self, protocol)
+
+    def _stale_arena(self, depth: int) -> None:
+        if depth in self.arenas:
+            self.arenas[depth] = None
+
+    def _pack(self, depth: int) -> None:
+        layouts = {}
+        for name in self._select(depth):
+            value = self._peek(name)
+            if _is_tensor(value):
+                layouts.setdefault((value.dtype, value.device), []).append(name)
+        packed = {}
+        for (dtype, device), names in layouts.items():
+            total = sum(self._peek(name).numel() for name in names)
+            buffer = torch.empty(total, dtype=dtype, device=device)
+            layout = []
+            offset = 0
+            for name in names:
+                value = self._peek(name)
+                n = value.numel()
+                buffer[offset:offset + n].copy_(value.reshape(-1))
+                layout.append((name, offset, value.shape))
+                offset += n
+            packed[(dtype, device)] = (buffer, layout)
+        self.arenas[depth] = packed
+        self._view_arena(depth)
+
+    def _view_arena(self, depth: int) -> None:
+        data = self._own("data")
+        for buffer, layout in self.arenas[depth].values():
+            for name, offset, shape in layout:
+                data[name] = buffer[offset:offset + shape.numel()].view(shape)
+            self._placed(name for name, _, _ in layout)
+        for data_type in self.groups.get(depth, {}):
+            self._bump(depth, data_type)
+
+    @_writes
+    def arena(self, depth: int) -> None:
+        """Opt a depth into arena mode: its tensors are packed per dtype and device into one flat buffer and exposed as views."""
+        if depth not in self.depths:
+            self._raise_exception(f"Depth {depth} is not configured.")
+        self._pack(depth)
+
+    @_writes
+    def arena_buffers(self, depth: int) -> Dict[Tuple[torch.dtype, torch.device], torch.Tensor]:
+        """Flat buffers backing an arena depth, repacked first if variables changed since the last pack."""
+        return self._arena_buffers(depth)
+
+    def _arena_buffers(self, depth: int) -> Dict[Tuple[torch.dtype, torch.device], torch.Tensor]:
+        if depth not in self.arenas:
+            self._raise_exception(f"Depth {depth} is not in arena mode.")
+        if self.arenas[depth] is None:
+            self._pack(depth)
+        return {key: buffer for key, (buffer, _) in self.arenas[depth].items()}
+
+    @_writes
+    def arena_map(self, depth: int, fn: Callable[[torch.Tensor], torch.Tensor]) -> None:
+        """Replace every buffer of an arena depth with fn(buffer) and re-point the variables at the result.
+
+        fn may also update a buffer in place, so every variable of the depth is marked dirty.
+        """
+        self._arena_buffers(depth)
+        packed = {}
+        for buffer, layout in self.arenas[depth].values():
+            moved = fn(buffer)
+            if moved.dim() != 1 or moved.numel() != buffer.numel():
+                self._raise_exception("Arena functions must return a flat buffer of the same length.")
+            key = (moved.dtype, moved.device)
+            if key in packed:
+                moved = torch.cat([packed[key][0], moved])
+                shift = packed[key][0].numel()
+                layout = packed[key][1] + [(name, offset + shift, shape) for name, offset, shape in layout]
+            packed[key] = (moved, layout)
+        self.arenas[depth] = packed
+        self._view_arena(depth)
+        for _, layout in packed.values():
+            self.dirty.update((name, None) for name, _, _ in layout)
+
+    def _depth_tensors(self, depth: int, data_type: Optional[Type], hold: bool = False) -> Tuple[List[str], List[torch.Tensor]]:
+        """Names and tensors at a depth, read without evicting anything.
+
+        With hold, spilled tensors are stored back so in-place updates stick;
+        they may exceed the budget until the caller passes the names to _placed.
+        """
+        tiering = self.tiering if hold else None
+        names, tensors = [], []
+        for name in self._select(depth, data_type):
+            if tiering is None:
+                value = self._peek(name)
+            else:
+                with tiering.lock:
+                    value = self.data[name]
+                    if type(value) is Spilled:
+                        value = value.load()
+                        self._own("data")[name] = value
+                        tiering.reloaded(self, name)
+            if _is_tensor(value):
+                names.append(name)
+                tensors.append(value)
+        return names, tensors
+
+    @_writes
+    def apply_foreach(self, depth: int, op: str, *args: Any, data_type: Optional[Type] = None) -> None:
+        """Apply one elementwise op to every tensor at a depth with a fused torch._foreach_<op> kernel.
+
+        op names the kernel without prefix or suffix, e.g. "mul", "add",
+        "clamp_min", "zero" or "lerp" (for an EMA, pass the target tensors and
+        the weight as args). Tensors are updated in place unless one of them
+        requires grad, in which case results are rebound out of place. Arena
+        depths without list arguments run the op on their flat buffers.
+        """
+        inplace_fn = getattr(torch, f"_foreach_{op}_", None)
+        outplace_fn = getattr(torch, f"_foreach_{op}", None)
+        if inplace_fn is None and outplace_fn is None:
+            self._raise_exception(f"torch has no _foreach_{op} kernel.")
+        names, tensors = self._depth_tensors(depth, data_type, hold=True)
+        if not tensors:
+            return
+        inplace = inplace_fn is not None and not any(t.requires_grad for t in tensors)
+
+        try:
+            if inplace and data_type is None and depth in self.arenas and not any(isinstance(a, (list, tuple)) for a in args):
+                inplace_fn(list(self._arena_buffers(depth).values()), *args)
+            elif inplace:
+                inplace_fn(tensors, *args)
+            else:
+                if outplace_fn is None:
+                    self._raise_exception(f"_foreach_{op} has no out-of-place form for tensors that require grad.")
+                data = self._own("data")
+                for name, result in zip(names, outplace_fn(tensors, *args)):
+                    data[name] = result
+                self._stale_arena(depth)
+        finally:
+            # Tensors reloaded for the kernel count against the budget again, and the coldest are spilled
+            self._placed(names)
+        for name in names:
+            self.dirty[name] = None
+            self._bump(depth, self.types[name])
+
+    @_reads
+    def reduce_foreach(self, depth: int, op: str = "norm", ord: float = 2.0, data_type: Optional[Type] = None,
+                       per_tensor: bool = False) -> Union[torch.Tensor, Dict[str, torch.Tensor], None]:
+        """Reduce every tensor at a depth with "norm", "sum" or "max", as one value or per tensor.
+
+        norm and max use the fused torch._foreach_norm / _foreach_max kernels
+        where available; sum runs once over the flat buffers of an arena depth
+        that is packed and up to date (a read never repacks).
+        """
+        names, tensors = self._depth_tensors(depth, data_type)
+        if not tensors:
+            return {} if per_tensor else None
+        if op == "norm":
+            partial = torch._foreach_norm(tensors, ord)
+        elif op == "max":
+            partial = torch._foreach_max(tensors) if hasattr(torch, "_foreach_max") else [t.max() for t in tensors]
+        elif op == "sum":
+            packed = self.arenas.get(depth)
+            if not per_tensor and data_type is None and packed:
+                buffers = [buffer for buffer, _ in packed.values()]
+                device = buffers[0].device
+                return torch.stack([b.sum().to(device) for b in buffers]).sum()
+            partial = [t.sum() for t in tensors]
+        else:
+            self._raise_exception(f"Unsupported reduction {op}; use norm, sum or max.")
+        if per_tensor:
+            return dict(zip(names, partial))
+        device = partial[0].device
+        stacked = torch.stack([p.to(device) for p in partial])
+        if op == "norm":
+            return torch.linalg.vector_norm(stacked, ord)
+        return stacked.max() if op == "max" else stacked.sum()
+
+    def _write(self, path: str, names: Iterable[str], delta: bool = False) -> None:
+        tensors = []
+        variables = []
+        offset = 0
+        for name in names:
+            value = self._peek(name)
+            entry = {"name": name, "type": _type_name(self.types[name]), "depth": self.levels[name]}
+            if _is_tensor(value):
+                value = value.detach().cpu().contiguous()
+                offset = _aligned(offset)
+                entry["tensor"] = {"dtype": str(value.dtype).split(".")[-1], "shape": list(value.shape),
+                                   "offset": offset, "nbytes": value.nbytes}
+                tensors.append((offset, value))
+                offset += value.nbytes
+            elif value is None or isinstance(value, (int, float, str)):
+                entry["value"] = value
+            else:
+                self._raise_exception(f"Cannot save {name}: values of type {type(value)} are not serialisable.")
+            variables.append(entry)
+
+        header = json.dumps({
+            "version": _FORMAT_VERSION,
+            "delta": delta,
+            "depths": [[depth, [_type_name(t) for t in types]] for depth, types in self.depths.items()],
+            "inosculations": [[[depth, _type_name(t)] for depth, t in key] for key in self.inosculations],
+            "variables": variables,
+        }).encode("utf-8")
+        payload_start = _aligned(len(_MAGIC) + 8 + len(header))
+        total = payload_start + offset
+
+        # Written aside and renamed into place, so an existing file (possibly mapped by a loaded store) is never truncated
+        staging = f"{path}.tmp"
+        with open(staging, "wb") as f:
+            f.write(_MAGIC + struct.pack("<Q", len(header)) + header)
+            f.truncate(total)
+        if tensors:
+            out = torch.from_file(staging, shared=True, size=total, dtype=torch.uint8)
+            for start, value in tensors:
+                out[payload_start + start:payload_start + start + value.nbytes].copy_(value.reshape(-1).view(torch.uint8))
+            del out
+        os.replace(staging, path)
+
+    @staticmethod
+    def _read(path: str, mmap: bool) -> Tuple[Dict[str, Any], List[Tuple[str, Type, int, Any]]]:
+        with open(path, "rb") as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise Exception(f"MangroveException: {path} is not a saved Mangrove.")
+            (header_len,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_len).decode("utf-8"))
+        if header["version"] != _FORMAT_VERSION:
+            raise Exception(f"MangroveException: Unsupported format version {header['version']}.")
+        payload_start = _aligned(len(_MAGIC) + 8 + header_len)
+        size = os.path.getsize(path)
+        buffer = torch.from_file(path, shared=False, size=size, dtype=torch.uint8) if size > payload_start else None
+
+        entries = []
+        for entry in header["variables"]:
+            if "tensor" in entry:
+                meta = entry["tensor"]
+                dtype = getattr(torch, meta["dtype"])
+                if not meta["nbytes"]:
+                    # No payload to map; a file of only empty tensors has no payload section at all
+                    value = torch.empty(meta["shape"], dtype=dtype)
+                else:
+                    start = payload_start + meta["offset"]
+                    value = buffer[start:start + meta["nbytes"]].view(dtype).view(meta["shape"])
+                    if not mmap:
+                        value = value.clone()
+            else:
+                value = entry["value"]
+            entries.append((entry["name"], _resolve_type(entry["type"]), entry["depth"], value))
+        return header, entries
+
+    def _merge(self, header: Dict[str, Any], entries: List[Tuple[str, Type, int, Any]]) -> None:
+        for depth, types in header["depths"]:
+            self.depths[depth] = [_resolve_type(t) for t in types]
+        for name, data_type, depth, value in entries:
+            old_depth = self.levels.get(name)
+            if old_depth != depth:
+                self._regroup(name, data_type, old_depth, depth, len(self.data))
+                if old_depth is not None:
+                    self._stale_arena(old_depth)
+            self._stale_arena(depth)
+            self._bump(depth, data_type)
+            if old_depth is not None and old_depth != depth:
+                self._bump(old_depth, data_type)
+            self.data[name] = value
+            self.types[name] = data_type
+            self.levels[name] = depth
+        for key in header["inosculations"]:
+            self.inosculations[tuple((depth, _resolve_type(t)) for depth, t in key)] = True
+
+    @_reads
+    def save(self, path: str) -> None:
+        """Write the store to a single file: a JSON header followed by aligned raw tensor payloads."""
+        self._write(path, self.data)
+
+    @_writes
+    def checkpoint(self, path: str) -> None:
+        """save(path), then start tracking changes afresh so later deltas are relative to this file."""
+        self._write(path, self.data)
+        self.dirty.clear()
+
+    @_writes
+    def checkpoint_delta(self, path: str) -> int:
+        """Write only the variables added, reassigned, pushed or shifted since the last checkpoint; returns how many."""
+        count = len(self.dirty)
+        self._write(path, list(self.dirty), delta=True)
+        self.dirty.clear()
+        return count
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "Mangrove":
+        """Rebuild a store written by save. With mmap, tensors are views onto the mapped file and pages are read on first touch."""
+        header, entries = cls._read(path, mmap)
+        if header.get("delta"):
+            raise Exception(f"MangroveException: {path} is a delta checkpoint; use restore() with its base.")
+        m = cls()
+        m._merge(header, entries)
+        m.dirty.clear()
+        return m
+
+    @classmethod
+    def restore(cls, base: str, deltas: Iterable[str], mmap: bool = True) -> "Mangrove":
+        """Load a full checkpoint and replay delta checkpoints over it, oldest first."""
+        m = cls.load(base, mmap)
+        for path in deltas:
+            header, entries = cls._read(path, mmap)
+            if not header.get("delta"):
+                raise Exception(f"MangroveException: {path} is not a delta checkpoint.")
+            m._merge(header, entries)
+        m.dirty.clear()
+        return m
+
+    @classmethod
+    def compact(cls, base: str, deltas: Iterable[str], path: str) -> "Mangrove":
+        """Fold a delta chain into a new full checkpoint at path (which may be base itself) and return the restored store."""
+        m = cls.restore(base, deltas)
+        m.checkpoint(path)
+        return m
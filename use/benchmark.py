@@ -0,0 +1,246 @@
+# Benchmarks for Mangroves
+#
+#   python use/benchmark.py                          run the full sweep and print it
+#   python use/benchmark.py --quick --out base.json  smaller sweep, saved as a baseline
+#   python use/benchmark.py --compare base.json      rerun and flag regressions against a baseline
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import torch
+from mangroves.mangrove import Mangrove
+
+FULL = {"sizes": (1_000, 10_000, 100_000), "depths": (1, 4, 16), "widths": (1, 2, 3), "combinations": 100_000, "tensors": 2_000, "instances": 100_000}
+QUICK = {"sizes": (1_000, 10_000), "depths": (1, 4), "widths": (1, 2, 3), "combinations": 10_000, "tensors": 200, "instances": 10_000}
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def build(n, depths):
+    m = Mangrove()
+    for d in range(1, depths + 1):
+        m.config(d, [int, float, torch.Tensor])
+    m.add_many((1 + k % depths, int, f"v{k}", k) for k in range(n))
+    return m
+
+def linear_var(m, depth, data_type):
+    # The pre-index lookup: a scan over every variable
+    return [name for name in m.data if depth == m.levels[name] and data_type == m.types[name]]
+
+def measure(fn, repeat):
+    # Median wall time of repeat runs of fn; setup that must not be timed belongs outside fn
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def bench_ingest(results, n, depths, repeat):
+    names = [f"v{k}" for k in range(n)]
+
+    def add_data():
+        m = Mangrove()
+        for d in range(1, depths + 1):
+            m.config(d, [int])
+        for k, name in enumerate(names):
+            m.add_data(1 + k % depths, int, [name], [k])
+
+    def add_many():
+        m = Mangrove()
+        for d in range(1, depths + 1):
+            m.config(d, [int])
+        m.add_many((1 + k % depths, int, name, k) for k, name in enumerate(names))
+
+    results[f"add_data[n={n},depths={depths}]"] = {"seconds": measure(add_data, repeat), "ops": n}
+    results[f"add_many[n={n},depths={depths}]"] = {"seconds": measure(add_many, repeat), "ops": n}
+
+def bench_access(results, n, depths, repeat):
+    m = build(n, depths)
+    names = list(m.data)
+    m.add_data(0, float, ["needle"], [1.0])  # a single match, where the index pays off most
+
+    def get():
+        for name in names:
+            getattr(m, name)
+
+    def set_():
+        for k, name in enumerate(names):
+            setattr(m, name, k)
+
+    def var():
+        for d in range(depths + 1):
+            m.var(d, int)
+
+    def var_scan():
+        for d in range(depths + 1):
+            linear_var(m, d, int)
+
+    def index():
+        for d in range(depths + 1):
+            m.index(d, int)
+
+    results[f"getattr[n={n},depths={depths}]"] = {"seconds": measure(get, repeat), "ops": n}
+    results[f"setattr[n={n},depths={depths}]"] = {"seconds": measure(set_, repeat), "ops": n}
+    results[f"var[n={n},depths={depths}]"] = {"seconds": measure(var, repeat), "ops": depths + 1}
+    results[f"var_scan[n={n},depths={depths}]"] = {"seconds": measure(var_scan, repeat), "ops": depths + 1}
+    results[f"lookup[n={n},depths={depths}]"] = {"seconds": measure(lambda: m.var(0, float), repeat), "ops": 1}
+    results[f"lookup_scan[n={n},depths={depths}]"] = {"seconds": measure(lambda: linear_var(m, 0, float), repeat), "ops": 1}
+    results[f"index[n={n},depths={depths}]"] = {"seconds": measure(index, repeat), "ops": depths + 1}
+    results[f"summary[n={n},depths={depths}]"] = {"seconds": measure(m.summary, repeat), "ops": 1}
+
+def bench_uproot(results, width, combinations, repeat):
+    # One group per depth, sized so the product stays near the requested number of combinations
+    per_depth = max(1, round(combinations ** (1 / width)))
+    m = Mangrove()
+    for d in range(1, width + 1):
+        m.config(d, [torch.Tensor])
+        m.add_many((d, torch.Tensor, f"t{d}_{k}", torch.full((8,), float(k))) for k in range(per_depth))
+    key = m.inosc([(d, torch.Tensor) for d in range(1, width + 1)])
+    total = per_depth ** width
+
+    def walk():
+        for _ in m.uproot_iter(key):
+            pass
+
+    def collate():
+        for _ in m.uproot_iter(key).collate(1024):
+            pass
+
+    tag = f"width={width},combinations={total}"
+    results[f"uproot[{tag}]"] = {"seconds": measure(lambda: m.uproot(key), repeat), "ops": total}
+    results[f"uproot_iter[{tag}]"] = {"seconds": measure(walk, repeat), "ops": total}
+    results[f"collate[{tag}]"] = {"seconds": measure(collate, repeat), "ops": total}
+
+def bench_moves(results, tensors, repeat):
+    m = Mangrove()
+    m.config(1, [torch.Tensor])
+    m.config(2, [torch.Tensor])
+    m.add_many((1, torch.Tensor, f"a{k}", torch.randn(1024)) for k in range(tensors))
+    m.add_many((2, torch.Tensor, f"b{k}", torch.randn(1024)) for k in range(tensors))
+    m.arena(2)
+
+    def roundtrip(depth):
+        m.to(dtype=torch.bfloat16, depth=depth)
+        m.to(dtype=torch.float32, depth=depth)
+
+    results[f"to[tensors={tensors}]"] = {"seconds": measure(lambda: roundtrip(1), repeat), "ops": 2 * tensors}
+    results[f"to_arena[tensors={tensors}]"] = {"seconds": measure(lambda: roundtrip(2), repeat), "ops": 2 * tensors}
+
+def bench_foreach(results, tensors, repeat):
+    m = Mangrove()
+    m.config(1, [torch.Tensor])
+    m.add_many((1, torch.Tensor, f"w{k}", torch.randn(256)) for k in range(tensors))
+
+    def loop():
+        for value in m.index(1, torch.Tensor).values():
+            value.mul_(0.999)
+
+    results[f"scale_loop[tensors={tensors}]"] = {"seconds": measure(loop, repeat), "ops": tensors}
+    results[f"apply_foreach[tensors={tensors}]"] = {"seconds": measure(lambda: m.apply_foreach(1, "mul", 0.999), repeat), "ops": tensors}
+    results[f"reduce_foreach[tensors={tensors}]"] = {"seconds": measure(lambda: m.reduce_foreach(1), repeat), "ops": tensors}
+
+def bench_construct(results, instances, repeat):
+    # Import time is taken in a fresh interpreter, where neither mangroves nor torch is loaded yet
+    probe = "import time; start = time.perf_counter(); import mangroves; print(time.perf_counter() - start)"
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    times = [float(subprocess.run([sys.executable, "-c", probe], env=env, capture_output=True, text=True, check=True).stdout)
+             for _ in range(repeat)]
+    results["import"] = {"seconds": statistics.median(times), "ops": 1}
+
+    depths = {1: [int, float], 2: [str]}
+    pool = Mangrove.pool(8, depths)
+
+    def construct():
+        for _ in range(instances):
+            m = Mangrove()
+            for depth, types in depths.items():
+                m.config(depth, types)
+
+    def pooled():
+        for _ in range(instances):
+            pool.release(pool.acquire())
+
+    results[f"construct[instances={instances}]"] = {"seconds": measure(construct, repeat), "ops": instances}
+    results[f"pool[instances={instances}]"] = {"seconds": measure(pooled, repeat), "ops": instances}
+
+def run(config, repeat):
+    results = {}
+    bench_construct(results, config["instances"], repeat)
+    for n in config["sizes"]:
+        for depths in config["depths"]:
+            bench_ingest(results, n, depths, repeat)
+            bench_access(results, n, depths, repeat)
+    for width in config["widths"]:
+        bench_uproot(results, width, config["combinations"], repeat)
+    bench_moves(results, config["tensors"], repeat)
+    bench_foreach(results, config["tensors"], repeat)
+    return results
+
+# (baseline, optimised) case pairs reported side by side
+SPEEDUPS = (("var_scan", "var"), ("lookup_scan", "lookup"), ("add_data", "add_many"),
+            ("scale_loop", "apply_foreach"), ("construct", "pool"))
+
+def speedups(results):
+    print(f"\n{'speedup':<48} {'baseline (ms)':>14} {'optimised (ms)':>15} {'ratio':>7}")
+    for case, now in results.items():
+        prefix, _, tag = case.partition("[")
+        for slow, fast in SPEEDUPS:
+            if prefix == slow and f"{fast}[{tag}" in results:
+                before, after = now["seconds"], results[f"{fast}[{tag}"]["seconds"]
+                print(f"{fast + '[' + tag:<48} {before * 1e3:>14.3f} {after * 1e3:>15.3f} {before / after:>6.1f}x")
+
+def compare(results, baseline, threshold):
+    # A case regresses when it is slower than the baseline by more than threshold (a fraction)
+    regressions = []
+    print(f"{'case':<48} {'baseline (ms)':>14} {'now (ms)':>10} {'ratio':>7}")
+    for case, now in results.items():
+        before = baseline.get(case)
+        if before is None:
+            continue
+        ratio = now["seconds"] / before["seconds"] if before["seconds"] else float("inf")
+        flag = "  REGRESSION" if ratio > 1 + threshold else ""
+        print(f"{case:<48} {before['seconds'] * 1e3:>14.3f} {now['seconds'] * 1e3:>10.3f} {ratio:>6.2f}x{flag}")
+        if flag:
+            regressions.append(case)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mangrove benchmark suite")
+    parser.add_argument("--quick", action="store_true", help="smaller sweep for local iteration")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case; the median is reported")
+    parser.add_argument("--out", help="write results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown fraction flagged as a regression")
+    args = parser.parse_args(argv)
+
+    results = run(QUICK if args.quick else FULL, args.repeat)
+    document = {
+        "meta": {"python": platform.python_version(), "torch": torch.__version__, "machine": platform.machine(),
+                 "quick": args.quick, "repeat": args.repeat},
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.threshold:.0%}")
+            return 1
+        return 0
+
+    print(f"{'case':<48} {'median (ms)':>12} {'ops/s':>14}")
+    for case, result in results.items():
+        print(f"{case:<48} {result['seconds'] * 1e3:>12.3f} {result['ops'] / result['seconds']:>14,.0f}")
+    speedups(results)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
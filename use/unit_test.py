@@ -1,6 +1,24 @@
+import asyncio
+import multiprocessing
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import ProcessPoolExecutor
 import torch
-from mangroves.mangrove import Mangrove
+from mangroves.mangrove import Mangrove, Prefetcher
+
+def read_shared(path):
+    m = Mangrove.attach(path)
+    return sorted(m.var()), m.t.sum().item(), m.t.is_shared()
+
+def read_pickled(blob):
+    m = pickle.loads(blob)
+    return sorted(m.var(1))
 
 class TestMangrove(unittest.TestCase):
 
@@ -192,5 +210,814 @@ class TestMangrove(unittest.TestCase):
             m.uproot(1, "y")
         self.assertTrue("Variable y is not at depth 1. Cannot uproot." in str(context.exception))
 
+    def test_index_follows_push_and_shift(self):
+        m = Mangrove()
+        m.config(1, [int, float])
+        m.config(2, [int])
+        m.add_data(0, int, ["a"], [1])
+        m.add_data(1, int, ["b", "c"], [2, 3])
+        m.add_data(1, float, ["f"], [0.5])
+        self.assertEqual(m.var(1, int), ["b", "c"])
+        self.assertEqual(m.var(1), ["b", "c", "f"])
+        self.assertEqual(m.var(data_type=int), ["a", "b", "c"])
+
+        m.push(2, "a")
+        m.shift(2, "b")
+        m.shift(0, "f")
+        self.assertEqual(m.var(0), ["f"])
+        self.assertEqual(m.var(1, int), ["c"])
+        self.assertEqual(m.index(2, int), {"a": 1, "b": 2})
+        self.assertEqual(m.var(1, float), [])
+
+        m.c = 30
+        self.assertEqual(m.index(1), {"c": 30})
+
+    def test_summary_inosculated_order(self):
+        m = Mangrove()
+        m.config(1, [int])
+        m.config(2, [int])
+        m.add_data(2, int, ["b"], [1])
+        m.add_data(1, int, ["a"], [2])
+        twice = m.inosc([(1, int), (1, int)])
+        both = m.inosc([(1, int), (2, int)])
+        inosculated = m.summary()["inosculated"]
+        self.assertEqual(inosculated[str(both)], ["b", "a"])
+        self.assertEqual(inosculated[str(twice)], ["a"])
+
+    def test_index_matches_linear_scan(self):
+        m = Mangrove()
+        m.config(1, [int, float])
+        m.add_data(1, int, [f"i{k}" for k in range(20)], list(range(20)))
+        m.add_data(0, float, [f"f{k}" for k in range(10)], [float(k) for k in range(10)])
+        for k in range(0, 10, 2):
+            m.push(1, f"f{k}")
+        for depth in (None, 0, 1, 2):
+            for data_type in (None, int, float, str):
+                expected = [name for name in m.data if (depth is None or m.levels[name] == depth) and (data_type is None or m.types[name] == data_type)]
+                self.assertEqual(m.var(depth, data_type), expected)
+
+    def test_index_keeps_insertion_order(self):
+        m = Mangrove()
+        m.config(1, [int, float])
+        m.config(2, [int])
+        m.add_data(1, int, ["b"], [1])
+        m.add_data(1, float, ["f"], [0.5])
+        m.add_data(1, int, ["c"], [2])
+        self.assertEqual(m.var(1), ["b", "f", "c"])
+        self.assertEqual(list(m.index(1)), ["b", "f", "c"])
+
+        m.shift(2, "b")
+        m.shift(1, "b")
+        self.assertEqual(m.var(1, int), ["b", "c"])
+        self.assertEqual(m.var(1), ["b", "f", "c"])
+        key = m.inosc([(1, int)])
+        self.assertEqual([row[0][0] for row in m.uproot(key)], ["b", "c"])
+
+    def test_uproot_iter_matches_uproot(self):
+        m = Mangrove()
+        m.config(1, [int])
+        m.config(2, [float])
+        m.add_data(1, int, ["a", "b", "c"], [1, 2, 3])
+        m.add_data(2, float, ["x", "y"], [0.5, 1.5])
+        key = m.inosc([(1, int), (2, float)])
+        eager = [tuple(row) for row in m.uproot(key)]
+        lazy = m.uproot_iter(key)
+        self.assertEqual(len(lazy), 6)
+        self.assertEqual(list(lazy), eager)
+        self.assertEqual([lazy[i] for i in range(-6, 6)], eager + eager)
+        with self.assertRaises(IndexError):
+            lazy[6]
+        self.assertEqual([len(b) for b in lazy.batches(4)], [4, 2])
+        self.assertEqual([c for b in lazy.batches(4, start=1) for c in b], eager[1:])
+
+    def test_uproot_iter_empty_group(self):
+        m = Mangrove()
+        m.config(1, [int])
+        m.config(2, [float])
+        m.add_data(1, int, ["a"], [1])
+        key = m.inosc([(1, int), (2, float)])
+        self.assertEqual(len(m.uproot_iter(key)), 0)
+        self.assertEqual(list(m.uproot_iter(key)), [])
+
+    def test_uproot_iter_collate(self):
+        m = Mangrove()
+        m.config(1, [torch.Tensor])
+        m.config(2, [float])
+        m.add_data(1, torch.Tensor, ["t0", "t1", "t2"], [torch.full((2,), float(k)) for k in range(3)])
+        m.add_data(2, float, ["x", "y"], [0.5, 1.5])
+        key = m.inosc([(1, torch.Tensor), (2, float)])
+        lazy = m.uproot_iter(key)
+        chunks = list(lazy.collate(4))
+        self.assertEqual(len(chunks), 2)
+        collated = [(names[0][r], tensors[0][r].tolist(), names[1][r], tensors[1][r].item())
+                    for tensors, names in chunks for r in range(len(names[0]))]
+        expected = [(a, va.tolist(), b, vb) for (a, va), (b, vb) in lazy]
+        self.assertEqual(collated, expected)
+        self.assertEqual(chunks[0][0][0].shape, (4, 2))
+
+    def test_collate_rejects_ragged_tensors(self):
+        m = Mangrove()
+        m.config(1, [torch.Tensor])
+        m.add_data(1, torch.Tensor, ["a", "b"], [torch.zeros(2), torch.zeros(3)])
+        key = m.inosc([(1, torch.Tensor)])
+        with self.assertRaises(Exception) as context:
+            list(m.uproot_iter(key).collate(2))
+        self.assertTrue("must share a shape" in str(context.exception))
+
+    def test_save_and_load(self):
+        m = Mangrove()
+        m.config(1, [int, torch.Tensor])
+        m.add_data(1, torch.Tensor, ["t", "h"], [torch.arange(6, dtype=torch.float32).view(2, 3), torch.tensor([1, 2], dtype=torch.float16)])
+        m.add_data(1, int, ["n"], [7])
+        m.add_data(0, str, ["label"], ["episode"])
+        key = m.inosc([(1, torch.Tensor)])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "store.mgv")
+            m.save(path)
+            for mmap in (True, False):
+                loaded = Mangrove.load(path, mmap=mmap)
+                self.assertEqual(loaded.depths, m.depths)
+                self.assertEqual(loaded.levels, m.levels)
+                self.assertEqual(loaded.types, m.types)
+                self.assertIn(key, loaded.inosculations)
+                self.assertTrue(torch.equal(loaded.t, m.t))
+                self.assertEqual(loaded.h.dtype, torch.float16)
+                self.assertEqual((loaded.n, loaded.label), (7, "episode"))
+                self.assertEqual(loaded.var(1, torch.Tensor), ["t", "h"])
+            mapped = Mangrove.load(path)
+            mapped.t.zero_()  # private mapping: writes never reach the file
+            self.assertTrue(torch.equal(Mangrove.load(path).t, m.t))
+
+    def test_save_and_load_empty_tensors(self):
+        m = Mangrove()
+        m.add_data(0, torch.Tensor, ["e", "g"], [torch.zeros(0), torch.zeros(0, 3, dtype=torch.int64)])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "empty.mgv")
+            m.save(path)
+            for mmap in (True, False):
+                loaded = Mangrove.load(path, mmap=mmap)
+                self.assertEqual((loaded.e.shape, loaded.e.dtype), (torch.Size([0]), torch.float32))
+                self.assertEqual((loaded.g.shape, loaded.g.dtype), (torch.Size([0, 3]), torch.int64))
+
+    def test_load_rejects_foreign_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "other")
+            with open(path, "wb") as f:
+                f.write(b"not a mangrove")
+            with self.assertRaises(Exception) as context:
+                Mangrove.load(path)
+            self.assertTrue("is not a saved Mangrove" in str(context.exception))
+
+    def test_arena_packs_depth_into_views(self):
+        m = Mangrove()
+        m.config(1, [torch.Tensor, int])
+        m.add_data(1, torch.Tensor, ["a", "b"], [torch.ones(2, 2), torch.full((3,), 2.0)])
+        m.add_data(1, torch.Tensor, ["c"], [torch.tensor([1, 2], dtype=torch.int64)])
+        m.add_data(1, int, ["n"], [3])
+        m.arena(1)
+        buffers = m.arena_buffers(1)
+        self.assertEqual(sorted(b.numel() for b in buffers.values()), [2, 7])
+        flat = buffers[(torch.float32, torch.device("cpu"))]
+        self.assertEqual(m.a.data_ptr(), flat.data_ptr())
+        flat.zero_()
+        self.assertEqual(m.b.tolist(), [0.0, 0.0, 0.0])
+        self.assertEqual(m.n, 3)
+
+    def test_arena_map_and_repack(self):
+        m = Mangrove()
+        m.config(1, [torch.Tensor])
+        m.add_data(1, torch.Tensor, ["a", "b"], [torch.ones(2), torch.tensor([1.0, 2.0], dtype=torch.float64)])
+        m.arena(1)
+        m.arena_map(1, lambda buffer: buffer.to(torch.bfloat16))
+        self.assertEqual(list(m.arena_buffers(1)), [(torch.bfloat16, torch.device("cpu"))])
+        self.assertEqual((m.a.dtype, m.b.tolist()), (torch.bfloat16, [1.0, 2.0]))
+
+        m.add_data(1, torch.Tensor, ["c"], [torch.zeros(4, dtype=torch.bfloat16)])
+        self.assertEqual(m.arena_buffers(1)[(torch.bfloat16, torch.device("cpu"))].numel(), 8)
+        self.assertEqual(m.c.shape, (4,))
+
+    def test_arena_requires_opt_in(self):
+        m = Mangrove()
+        m.config(1, [torch.Tensor])
+        with self.assertRaises(Exception) as context:
+            m.arena_buffers(1)
+        self.assertTrue("Depth 1 is not in arena mode." in str(context.exception))
+
+    def test_add_data_without_values(self):
+        m = Mangrove()
+        m.config(1, [int])
+        m.add_data(1, int, ["x", "y"])
+        self.assertEqual(m.data, {"x": None, "y": None})
+
+    def test_add_many(self):
+        m = Mangrove()
+        m.config(1, [int, torch.Tensor])
+        m.add_many([(1, int, "x", 1), (0, str, "s", "a"), (1, torch.Tensor, "t", torch.zeros(2))])
+        self.assertEqual(m.levels, {"x": 1, "s": 0, "t": 1})
+        self.assertEqual(m.var(1, int), ["x"])
+        self.assertEqual(m.s, "a")
+
+    def test_add_many_is_atomic(self):
+        m = Mangrove()
+        m.config(1, [int])
+        m.add_data(1, int, ["x"], [1])
+        for records, message in [
+            ([(1, int, "a", 1), (1, int, "x", 2)], "Variable name x is already in use."),
+            ([(1, int, "a", 1), (1, int, "a", 2)], "Variable name a is already in use."),
+            ([(1, int, "a", 1), (1, float, "b", 2.0)], "Type <class 'float'> is not allowed at depth 1."),
+            ([(1, int, "a", 1), (2, int, "b", 2)], "Depth 2 not configured. Please configure the depth first."),
+        ]:
+            with self.assertRaises(Exception) as context:
+                m.add_many(records)
+            self.assertTrue(message in str(context.exception))
+            self.assertEqual(m.data, {"x": 1})
+            self.assertEqual(m.var(1), ["x"])
+
+    def test_to_casts_floating_tensors(self):
+        m = Mangrove()
+        m.config(1, [torch.Tensor, int])
+        m.config(2, [torch.Tensor])
+        m.add_data(1, torch.Tensor, ["w", "idx"], [torch.ones(4), torch.arange(4)])
+        m.add_data(1, int, ["n"], [1])
+        m.add_data(2, torch.Tensor, ["hot"], [torch.ones(4)])
+        moved = m.to(dtype=torch.bfloat16, depth=1)
+        self.assertEqual(moved, 8)
+        self.assertEqual((m.w.dtype, m.idx.dtype, m.hot.dtype), (torch.bfloat16, torch.int64, torch.float32))
+        self.assertEqual(m.to(dtype=torch.bfloat16, depth=1), 0)
+        self.assertEqual(m.to("cpu"), 0)
+
+    def test_to_many_tensors_and_arena(self):
+        m = Mangrove()
+        m.config(1, [torch.Tensor])
+        m.config(2, [torch.Tensor])
+        m.add_data(1, torch.Tensor, [f"t{k}" for k in range(50)], [torch.full((3,), float(k)) for k in range(50)])
+        m.add_data(2, torch.Tensor, ["a", "b"], [torch.ones(2), torch.ones(3)])
+        m.arena(2)
+        self.assertEqual(m.to(dtype=torch.float64, max_workers=3), 50 * 3 * 8 + 5 * 8)
+        self.assertEqual([m.data[f"t{k}"][0].item() for k in range(50)], [float(k) for k in range(50)])
+        self.assertEqual(list(m.arena_buffers(2)), [(torch.float64, torch.device("cpu"))])
+
+    def test_to_pin_memory(self):
+        m = Mangrove()
+        m.config(1, [torch.Tensor])
+        m.add_data(1, torch.Tensor, ["t"], [torch.ones(2)])
+        m.to("cpu", dtype=torch.float16, pin_memory=True)
+        self.assertEqual(m.t.dtype, torch.float16)
+        self.assertEqual(m.t.is_pinned(), torch.cuda.is_available())
+
+    def test_snapshot_is_stable_across_writes(self):
+        m = Mangrove()
+        m.config(1, [int])
+        m.concurrent()
+        m.add_data(0, int, ["a"], [1])
+        view = m.snapshot()
+        self.assertIs(m.snapshot(), view)
+        m.push(1, "a")
+        m.a = 5
+        self.assertEqual(view.index(), {"a": 1})
+        self.assertEqual(view.levels, {"a": 0})
+        self.assertEqual(m.index(1), {"a": 5})
+        self.assertIsNot(m.snapshot(), view)
+
+    def test_snapshot_copies_on_write(self):
+        m = Mangrove()
+        m.config(1, [int])
+        m.config(2, [int])
+        m.concurrent()
+        m.add_data(1, int, ["a", "b"], [1, 2])
+        m.add_data(2, int, ["c"], [3])
+        view = m.snapshot()
+        self.assertIs(view.data, m.data)
+        self.assertIs(view.groups, m.groups)
+
+        m.a = 10
+        self.assertIsNot(m.data, view.data)
+        self.assertIs(m.groups, view.groups)
+        m.b = 20  # the table is private to the writer now
+        self.assertEqual(view.index(1), {"a": 1, "b": 2})
+
+        m.shift(2, "b")
+        self.assertIsNot(m.groups[2], view.groups[2])
+        self.assertEqual(view.var(2), ["c"])
+        self.assertEqual(m.var(2), ["b", "c"])
+        self.assertEqual(m.index(1), {"a": 10})
+
+    def test_concurrent_stress(self):
+        m = Mangrove()
+        m.config(1, [int])
+        m.config(2, [int])
+        m.concurrent()
+        key = m.inosc([(1, int), (2, int)])
+        stop = threading.Event()
+        errors = []
+
+        def produce():
+            for k in range(400):
+                m.add_data(0, int, [f"v{k}"], [k])
+                m.push(1 + k % 2, f"v{k}")
+                setattr(m, f"v{k}", -k)
+                if k % 3 == 0:
+                    m.shift(0, f"v{k}")
+            stop.set()
+
+        def consume():
+            try:
+                while not stop.is_set():
+                    view = m.snapshot()
+                    for depth in (0, 1, 2):
+                        for name in view.var(depth, int):
+                            self.assertEqual(view.levels[name], depth)
+                    self.assertEqual(sum(len(view.var(depth)) for depth in (0, 1, 2)), len(view.var()))
+                    self.assertEqual(len(view.uproot(key)), len(view.var(1)) * len(view.var(2)))
+                    summary = view.summary()
+                    self.assertEqual(len(summary["configured"]) + len(summary["unconfigured (depth 0)"]), len(view.var()))
+                    m.summary()
+            except Exception as e:
+                errors.append(e)
+
+        readers = [threading.Thread(target=consume) for _ in range(8)]
+        writer = threading.Thread(target=produce)
+        for t in readers + [writer]:
+            t.start()
+        for t in readers + [writer]:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(m.var()), 400)
+        self.assertEqual(sorted(m.var(0)), sorted(f"v{k}" for k in range(0, 400, 3)))
+
+    def test_shared_across_processes(self):
+        m = Mangrove()
+        m.config(1, [torch.Tensor, int])
+        m.add_data(1, torch.Tensor, ["t"], [torch.zeros(4)])
+        path = m.share()
+        self.assertTrue(m.t.is_shared())
+        with ProcessPoolExecutor(3, mp_context=multiprocessing.get_context("fork")) as pool:
+            self.assertEqual(list(pool.map(read_shared, [path] * 3)), [(["t"], 0.0, True)] * 3)
+            m.t.add_(1)
+            m.add_data(1, int, ["n"], [1])
+            self.assertEqual(list(pool.map(read_shared, [path] * 3)), [(["t"], 4.0, True)] * 3)
+            m.publish()
+            self.assertEqual(list(pool.map(read_shared, [path] * 3)), [(["n", "t"], 4.0, True)] * 3)
+            self.assertEqual(list(pool.map(read_pickled, [pickle.dumps(m)] * 2)), [["n", "t"]] * 2)
+
+    def test_shared_with_spawned_workers_across_epochs(self):
+        m = Mangrove()
+        m.config(1, [torch.Tensor, int])
+        m.add_data(1, torch.Tensor, ["t"], [torch.zeros(4)])
+        path = m.share()
+        context = multiprocessing.get_context("spawn")
+        for epoch in range(3):
+            # Fresh workers every epoch, each attaching more than once
+            with ProcessPoolExecutor(2, mp_context=context) as pool:
+                self.assertEqual(list(pool.map(read_shared, [path] * 4)), [(["t"], 4.0 * epoch, True)] * 4)
+            m.t.add_(1)
+        m.t = torch.full((4,), 2.0)  # the old storage is released, the new one published
+        m.publish()
+        with ProcessPoolExecutor(2, mp_context=multiprocessing.get_context("forkserver")) as pool:
+            self.assertEqual(list(pool.map(read_shared, [path] * 3)), [(["t"], 8.0, True)] * 3)
+
+    def test_attached_store_follows_publish(self):
+        m = Mangrove()
+        m.config(1, [int])
+        path = m.share()
+        reader = Mangrove.attach(path)
+        self.assertEqual(reader.var(), [])
+        m.add_data(1, int, ["x"], [1])
+        m.publish()
+        self.assertEqual(reader.x, 1)
+        self.assertEqual(reader.var(1, int), ["x"])
+        with self.assertRaises(Exception) as context:
+            reader.publish()
+        self.assertTrue("Only a Mangrove that called share() can publish." in str(context.exception))
+
+    def test_instrumentation(self):
+        m = Mangrove()
+        m.config(1, [int, torch.Tensor])
+        calls = []
+        stats = m.instrument(window=4, hook=lambda method, seconds: calls.append(method))
+        m.add_data(1, int, ["x"], [1])
+        for _ in range(6):
+            m.x
+        m.x = 2
+        m.var(1)
+        report = stats.report()
+        self.assertEqual(report["__getattr__"]["calls"], 6)
+        self.assertEqual(len(stats.samples["__getattr__"]), 4)
+        self.assertEqual((report["add_data"]["calls"], report["__setattr__"]["calls"], report["var"]["calls"]), (1, 1, 1))
+        self.assertTrue(0 <= report["__getattr__"]["p50"] <= report["__getattr__"]["p99"])
+        self.assertEqual(calls, ["add_data"] + ["__getattr__"] * 6 + ["__setattr__", "var"])
+        m.instrument(False)
+        m.x
+        self.assertEqual(stats.report()["__getattr__"]["calls"], 6)
+
+    def test_instrumentation_records_outermost_calls(self):
+        m = Mangrove()
+        m.config(1, [torch.Tensor])
+        m.add_data(1, torch.Tensor, ["a", "b"], [torch.ones(2), torch.ones(3)])
+        m.arena(1)
+        stats = m.instrument()
+        m.to(dtype=torch.float64)
+        m.apply_foreach(1, "add", 1.0)
+        m.a = torch.zeros(2, dtype=torch.float64)
+        self.assertEqual(float(m.reduce_foreach(1, "sum")), 6.0)
+        self.assertIsNone(m.arenas[1])  # a read does not repack
+        self.assertEqual({method: row["calls"] for method, row in stats.report().items()},
+                         {"to": 1, "apply_foreach": 1, "__setattr__": 1, "reduce_foreach": 1})
+
+    def test_memory_accounting(self):
+        m = Mangrove()
+        m.config(1, [int, torch.Tensor])
+        m.add_data(1, torch.Tensor, ["a", "b"], [torch.zeros(4), torch.zeros(2, dtype=torch.float64)])
+        m.add_data(1, int, ["n"], [1])
+        accounting = m.memory()
+        self.assertEqual(accounting[1][torch.Tensor], {"variables": 2, "tensors": 2, "numel": 6, "nbytes": 32, "devices": {"cpu": 32}})
+        self.assertEqual(accounting[1][int]["nbytes"], 0)
+
+    def test_budget_spills_low_priority_depths(self):
+        m = Mangrove()
+        m.config(1, [torch.Tensor])
+        m.config(2, [torch.Tensor])
+        m.add_data(2, torch.Tensor, ["hot"], [torch.full((64,), 2.0)])
+        m.add_data(1, torch.Tensor, ["a", "b", "c"], [torch.full((64,), float(k)) for k in range(3)])
+        with tempfile.TemporaryDirectory() as tmp:
+            m.budget(3 * 256, priorities={1: 0, 2: 1}, spill_dir=tmp)
+            self.assertEqual(m.tiering.report()["evictions"], 1)
+            self.assertEqual(m.tiering.report()["spilled"], 1)
+            self.assertIn("a", m.tiering.spilled)
+            self.assertEqual(len(os.listdir(tmp)), 1)
+
+            m.b  # b becomes most recently used, so c is the next victim
+            self.assertEqual(m.a.tolist(), [0.0] * 64)
+            report = m.tiering.report()
+            self.assertEqual((report["reloads"], report["evictions"], report["resident"]), (1, 2, 3 * 256))
+            self.assertIn("c", m.tiering.spilled)
+            self.assertEqual(m.index(1)["c"].tolist(), [2.0] * 64)
+            self.assertTrue(torch.equal(m.hot, torch.full((64,), 2.0)))
+
+            m.budget(None)
+            self.assertIsNone(m.tiering)
+            self.assertEqual(os.listdir(tmp), [])
+            self.assertEqual([m.data[name].sum().item() for name in ("a", "b", "c")], [0.0, 64.0, 128.0])
+
+    def test_budget_reload_in_concurrent_mode(self):
+        m = Mangrove()
+        m.config(1, [torch.Tensor])
+        m.add_data(1, torch.Tensor, ["a", "b"], [torch.full((16,), float(k)) for k in range(2)])
+        m.concurrent()
+        m.budget(64)
+        self.assertIn("a", m.tiering.spilled)
+        view = m.snapshot()
+        generation = m.generation
+        self.assertEqual(m.a.tolist(), [0.0] * 16)  # reloads a and evicts b
+        self.assertGreater(m.generation, generation)
+        self.assertIsNot(m.data, view.data)
+        self.assertEqual(type(view.data["a"]).__name__, "Spilled")
+        self.assertNotEqual(type(view.data["b"]).__name__, "Spilled")
+        self.assertEqual([t.tolist() for t in view.index(1).values()], [[0.0] * 16, [1.0] * 16])
+        m.budget(None)
+
+    def test_foreach_under_budget(self):
+        m = Mangrove()
+        m.config(1, [torch.Tensor])
+        m.add_data(1, torch.Tensor, ["a", "b", "c"], [torch.zeros(16) for _ in range(3)])
+        m.budget(64)
+        m.apply_foreach(1, "add", 1.0)
+        self.assertEqual(m.tiering.report()["resident"], 64)
+        self.assertEqual(m.tiering.report()["spilled"], 2)
+        self.assertEqual({name: value.sum().item() for name, value in m.reduce_foreach(1, "sum", per_tensor=True).items()},
+                         {"a": 16.0, "b": 16.0, "c": 16.0})
+        self.assertEqual(m.tiering.report()["spilled"], 2)
+        self.assertEqual(m.reduce_foreach(1, "max").item(), 1.0)
+        m.budget(None)
+        self.assertEqual([m.data[name].sum().item() for name in ("a", "b", "c")], [16.0] * 3)
+
+    def test_budget_reassignment_and_uproot(self):
+        m = Mangrove()
+        m.config(1, [torch.Tensor])
+        m.add_data(1, torch.Tensor, ["a", "b"], [torch.zeros(16), torch.ones(16)])
+        m.budget(64)
+        self.assertEqual(m.tiering.report()["spilled"], 1)
+        m.a = torch.full((16,), 5.0)
+        self.assertEqual(m.tiering.report()["resident"], 64)
+        key = m.inosc([(1, torch.Tensor)])
+        self.assertEqual(sorted(v.sum().item() for ((_, v),) in m.uproot(key)), [16.0, 80.0])
+        self.assertEqual(sorted(v.sum().item() for ((_, v),) in m.uproot_iter(key)), [16.0, 80.0])
+
+    def test_prefetch_abandoned_iterator_stops_its_thread(self):
+        m = Mangrove()
+        m.config(1, [int])
+        m.add_data(1, int, [f"i{k}" for k in range(100)], list(range(100)))
+        key = m.inosc([(1, int)])
+        before = threading.active_count()
+        for _ in range(5):
+            for batch in m.prefetch(key, 1, ahead=1):
+                break
+        deadline = time.monotonic() + 5
+        while threading.active_count() > before and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(threading.active_count(), before)
+
+    def test_prefetch_under_budget_while_consumer_reads(self):
+        m = Mangrove()
+        m.config(1, [torch.Tensor])
+        names = [f"t{k}" for k in range(16)]
+        m.add_data(1, torch.Tensor, names, [torch.full((16,), float(k)) for k in range(16)])
+        m.budget(4 * 64)
+        key = m.inosc([(1, torch.Tensor)])
+        for _ in range(3):
+            seen = []
+            with m.prefetch(key, 1, ahead=1) as batches:
+                for (combination,) in batches:
+                    (name, value), = combination
+                    seen.append(value[0].item())
+                    for other in names:
+                        getattr(m, other)
+            self.assertEqual(seen, [float(k) for k in range(16)])
+        self.assertEqual(m.tiering.report()["spilled"], 12)
+        m.budget(None)
+
+    def test_prefetch_async_cancellation(self):
+        def slow():
+            for k in range(100):
+                time.sleep(0.2)
+                yield k
+
+        async def consume(batches):
+            async for _ in batches:
+                pass
+
+        async def main():
+            async with Prefetcher(slow(), ahead=1) as batches:
+                task = asyncio.ensure_future(consume(batches))
+                await asyncio.sleep(0.3)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+
+        # asyncio.run() waits for the default executor, so a consumer thread stuck in the queue would hang it
+        runner = threading.Thread(target=asyncio.run, args=(main(),), daemon=True)
+        runner.start()
+        runner.join(10)
+        self.assertFalse(runner.is_alive())
+
+    def test_budget_with_to_arena_and_memory(self):
+        m = Mangrove()
+        m.config(1, [torch.Tensor])
+        m.add_data(1, torch.Tensor, ["a", "b"], [torch.zeros(16), torch.ones(16)])
+        m.budget(64)
+        self.assertEqual(m.tiering.report()["spilled"], 1)
+        entry = m.memory()[1][torch.Tensor]
+        self.assertEqual((entry["tensors"], entry["numel"], entry["nbytes"]), (2, 32, 128))
+
+        m.to(dtype=torch.float64)
+        self.assertEqual((m.a.dtype, m.b.dtype), (torch.float64, torch.float64))
+        self.assertEqual((m.a.sum().item(), m.b.sum().item()), (0.0, 16.0))
+
+        m.budget(None)
+        m.add_data(1, torch.Tensor, ["c"], [torch.full((16,), 2.0, dtype=torch.float64)])
+        m.budget(256)
+        self.assertEqual(m.tiering.report()["spilled"], 1)
+        m.arena(1)
+        self.assertEqual([v.sum().item() for v in m.index(1).values()], [0.0, 16.0, 32.0])
+        self.assertEqual(sum(b.numel() for b in m.arena_buffers(1).values()), 48)
+
+    def test_prefetch_sync_and_async(self):
+        m = Mangrove()
+        m.config(1, [int])
+        m.config(2, [torch.Tensor])
+        m.add_data(1, int, [f"i{k}" for k in range(5)], list(range(5)))
+        m.add_data(2, torch.Tensor, ["a", "b"], [torch.zeros(3), torch.ones(3)])
+        key = m.inosc([(1, int), (2, torch.Tensor)])
+        expected = list(m.uproot_iter(key).batches(3))
+        with m.prefetch(key, 3, ahead=1) as batches:
+            self.assertEqual([[name for name, _ in row] for batch in batches for row in batch],
+                             [[name for name, _ in row] for batch in expected for row in batch])
+
+        async def consume():
+            shapes = []
+            async with m.prefetch(key, 4, collate=True) as batches:
+                async for tensors, names in batches:
+                    shapes.append((tuple(tensors[0].shape), tuple(tensors[1].shape)))
+            return shapes
+
+        self.assertEqual(asyncio.run(consume()), [((4,), (4, 3)), ((4,), (4, 3)), ((2,), (2, 3))])
+
+    def test_prefetch_close_and_errors(self):
+        m = Mangrove()
+        m.config(1, [int])
+        m.add_data(1, int, [f"i{k}" for k in range(1000)], list(range(1000)))
+        key = m.inosc([(1, int)])
+        batches = m.prefetch(key, 1, ahead=2)
+        next(batches)
+        batches.close()
+        self.assertFalse(batches.thread.is_alive())
+        self.assertEqual(list(batches), [])
+
+        m.config(2, [torch.Tensor])
+        m.add_data(2, torch.Tensor, ["a", "b"], [torch.zeros(2), torch.zeros(3)])
+        with self.assertRaises(Exception) as context:
+            list(m.prefetch(m.inosc([(2, torch.Tensor)]), 2, collate=True))
+        self.assertTrue("must share a shape" in str(context.exception))
+
+    def test_dirty_tracking(self):
+        m = Mangrove()
+        m.config(1, [int, torch.Tensor])
+        m.add_data(0, int, ["a", "b"], [1, 2])
+        m.add_data(1, torch.Tensor, ["t", "u"], [torch.zeros(2), torch.zeros(2)])
+        with tempfile.TemporaryDirectory() as tmp:
+            m.checkpoint(os.path.join(tmp, "base"))
+            self.assertEqual(m.dirty, {})
+            m.a = 10
+            m.push(1, "b")
+            m.add_many([(1, int, "c", 3)])
+            m.to(dtype=torch.float64, data_type=torch.Tensor)
+            self.assertEqual(sorted(m.dirty), ["a", "b", "c", "t", "u"])
+
+    def test_delta_checkpoints_restore_and_compact(self):
+        m = Mangrove()
+        m.config(1, [int, torch.Tensor])
+        m.add_data(0, int, ["a", "b"], [1, 2])
+        m.add_data(1, torch.Tensor, ["t", "u"], [torch.zeros(3), torch.ones(3)])
+        with tempfile.TemporaryDirectory() as tmp:
+            base, first, second = (os.path.join(tmp, name) for name in ("base", "d1", "d2"))
+            m.checkpoint(base)
+            m.a = 10
+            m.t = torch.full((3,), 7.0)
+            self.assertEqual(m.checkpoint_delta(first), 2)
+            m.push(1, "b")
+            m.add_data(1, torch.Tensor, ["v"], [torch.arange(3.0)])
+            key = m.inosc([(1, torch.Tensor)])
+            self.assertEqual(m.checkpoint_delta(second), 2)
+            self.assertLess(os.path.getsize(second), os.path.getsize(base) + 64)
+
+            restored = Mangrove.restore(base, [first, second])
+            self.assertEqual(restored.levels, m.levels)
+            self.assertEqual((restored.a, restored.b), (10, 2))
+            self.assertEqual(restored.var(1, int), ["b"])
+            self.assertEqual(sorted(restored.var(1, torch.Tensor)), ["t", "u", "v"])
+            self.assertTrue(torch.equal(restored.t, m.t))
+            self.assertIn(key, restored.inosculations)
+            self.assertEqual(restored.dirty, {})
+
+            compacted = Mangrove.compact(base, [first, second], base)
+            reloaded = Mangrove.load(base)
+            self.assertEqual(reloaded.levels, compacted.levels)
+            self.assertEqual((reloaded.a, reloaded.b), (10, 2))
+            self.assertTrue(torch.equal(reloaded.t, m.t))
+            self.assertTrue(torch.equal(reloaded.v, torch.arange(3.0)))
+
+            with self.assertRaises(Exception) as context:
+                Mangrove.load(first)
+            self.assertTrue("is a delta checkpoint" in str(context.exception))
+            with self.assertRaises(Exception) as context:
+                Mangrove.restore(base, [base])
+            self.assertTrue("is not a delta checkpoint" in str(context.exception))
+
+    def test_delta_checkpoint_after_arena_map(self):
+        m = Mangrove()
+        m.config(1, [torch.Tensor])
+        m.add_data(1, torch.Tensor, ["a", "b"], [torch.ones(2), torch.ones(3)])
+        m.arena(1)
+        with tempfile.TemporaryDirectory() as tmp:
+            base, delta = os.path.join(tmp, "base"), os.path.join(tmp, "delta")
+            m.checkpoint(base)
+            m.arena_map(1, lambda buffer: buffer * 2)
+            self.assertEqual(m.checkpoint_delta(delta), 2)
+            restored = Mangrove.restore(base, [delta])
+            self.assertEqual((restored.a.tolist(), restored.b.tolist()), ([2.0] * 2, [2.0] * 3))
+
+    def test_memoized_uproot_invalidation(self):
+        m = Mangrove()
+        m.config(1, [int, float])
+        m.config(2, [int])
+        m.add_data(1, int, ["a", "b"], [1, 2])
+        m.add_data(2, int, ["x"], [10])
+        key = m.inosc([(1, int), (2, int)])
+        cache = m.memoize(size=2)
+
+        first = m.uproot(key)
+        self.assertIs(m.uproot(key), first)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        m.add_data(1, float, ["f"], [0.5])  # unrelated group
+        self.assertIs(m.uproot(key), first)
+
+        m.a = 5
+        self.assertEqual(m.uproot(key)[0], [("a", 5), ("x", 10)])
+        m.add_data(0, int, ["z"], [0])  # depth 0 is not part of the key
+        self.assertEqual(len(m.uproot(key)), 2)
+        m.push(2, "z")
+        self.assertEqual(len(m.uproot(key)), 4)
+        m.shift(0, "b")
+        self.assertEqual(len(m.uproot(key)), 2)
+        self.assertEqual(cache.report(), {"size": 2, "entries": 1, "hits": 3, "misses": 4})
+
+        other = m.inosc([(1, float), (2, int)])
+        third = m.inosc([(1, int)])
+        m.uproot(other)
+        m.uproot(third)
+        self.assertEqual(list(cache.entries), [other, third])
+
+        m.memoize(None)
+        self.assertIsNot(m.uproot(third), m.uproot(third))
+
+    def test_apply_foreach(self):
+        m = Mangrove()
+        m.config(1, [torch.Tensor, int])
+        m.config(2, [torch.Tensor])
+        m.add_data(1, torch.Tensor, ["a", "b"], [torch.ones(3), torch.full((2, 2), 4.0)])
+        m.add_data(1, int, ["n"], [3])
+        m.add_data(2, torch.Tensor, ["ema_a", "ema_b"], [torch.zeros(3), torch.zeros(2, 2)])
+        a = m.a
+        m.apply_foreach(1, "mul", 0.5)
+        self.assertIs(m.a, a)
+        self.assertEqual((m.a.tolist(), m.b[0].tolist(), m.n), ([0.5] * 3, [2.0, 2.0], 3))
+        m.apply_foreach(1, "clamp_max", 1.0)
+        self.assertEqual(m.b.max().item(), 1.0)
+        m.apply_foreach(2, "lerp", [m.a, m.b], 0.5)
+        self.assertEqual((m.ema_a.tolist(), m.ema_b.sum().item()), ([0.25] * 3, 2.0))
+        m.apply_foreach(2, "zero")
+        self.assertEqual(m.ema_b.abs().sum().item(), 0.0)
+        with self.assertRaises(Exception) as context:
+            m.apply_foreach(1, "nonsense")
+        self.assertTrue("torch has no _foreach_nonsense kernel." in str(context.exception))
+
+    def test_apply_foreach_arena_and_grad(self):
+        m = Mangrove()
+        m.config(1, [torch.Tensor])
+        m.add_data(1, torch.Tensor, ["a", "b"], [torch.ones(2), torch.ones(3)])
+        m.arena(1)
+        m.apply_foreach(1, "add", 1.0)
+        self.assertEqual((m.a.tolist(), m.b.tolist()), ([2.0] * 2, [2.0] * 3))
+
+        m.config(2, [torch.Tensor])
+        w = torch.ones(2, requires_grad=True)
+        m.add_data(2, torch.Tensor, ["w"], [w])
+        m.apply_foreach(2, "mul", 3.0)
+        self.assertIsNot(m.w, w)
+        self.assertEqual(w.tolist(), [1.0, 1.0])
+        self.assertEqual(m.w.tolist(), [3.0, 3.0])
+
+    def test_reduce_foreach(self):
+        m = Mangrove()
+        m.config(1, [torch.Tensor])
+        m.add_data(1, torch.Tensor, ["a", "b"], [torch.tensor([3.0, 4.0]), torch.tensor([-12.0])])
+        self.assertAlmostEqual(m.reduce_foreach(1).item(), 13.0, places=5)
+        self.assertEqual(m.reduce_foreach(1, "sum").item(), -5.0)
+        self.assertEqual(m.reduce_foreach(1, "max").item(), 4.0)
+        self.assertEqual({k: v.item() for k, v in m.reduce_foreach(1, "norm", ord=1, per_tensor=True).items()}, {"a": 7.0, "b": 12.0})
+        m.arena(1)
+        self.assertEqual(m.reduce_foreach(1, "sum").item(), -5.0)
+        self.assertIsNone(m.reduce_foreach(0))
+
+    def test_import_without_torch(self):
+        probe = ("import sys; from mangroves import Mangrove; m = Mangrove(); m.config(1, [int]); "
+                 "m.add_data(1, int, ['a'], [1]); m.summary(); m.memory(); print('torch' in sys.modules, len(m.depths[0])); "
+                 "import torch; m.add_data(0, torch.Tensor, ['t'], [torch.ones(1)]); print(m.depths[0][-1] is torch.Tensor)")
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        out = subprocess.run([sys.executable, "-c", probe], cwd=root, capture_output=True, text=True, check=True).stdout
+        self.assertEqual(out.split(), ["False", "3", "True"])
+
+    def test_reset(self):
+        m = Mangrove()
+        m.config(1, [int])
+        m.add_data(1, int, ["a"], [1])
+        m.inosc([(1, int)])
+        m.concurrent()
+        m.memoize()
+        m.reset({2: [str]})
+        self.assertEqual((m.data, m.types, m.levels, m.groups, m.inosculations, m.dirty), ({}, {}, {}, {}, {}, {}))
+        self.assertEqual(m.depths, {0: [int, float, str, torch.Tensor], 2: [str]})
+        self.assertIsNone(m.lock)
+        self.assertIsNone(m.memo)
+        m.add_data(2, str, ["s"], ["x"])
+        self.assertEqual(m.s, "x")
+        with self.assertRaises(Exception):
+            m.reset({0: [int]})
+
+    def test_pool(self):
+        pool = Mangrove.pool(1, {1: [int]})
+        first = pool.acquire()
+        first.add_data(1, int, ["a"], [1])
+        pool.release(first)
+        with pool.borrow() as m:
+            self.assertIs(m, first)
+            self.assertEqual(m.var(), [])
+            self.assertEqual(m.depths[1], [int])
+            other = pool.acquire()
+            self.assertIsNot(other, m)
+        pool.release(other)
+        self.assertEqual(pool.report(), {"size": 1, "idle": 1, "created": 2, "reused": 1})
+
+        a = pool.acquire()
+        pool.release(a)
+        with self.assertRaises(Exception) as context:
+            pool.release(a)
+        self.assertTrue("not checked out of the pool" in str(context.exception))
+        self.assertIsNot(pool.acquire(), pool.acquire())
+        self.assertEqual(list(pool.lent), [id(a)])  # the other instance was dropped without release
+        with self.assertRaises(Exception):
+            pool.release(Mangrove())
+
 if __name__ == '__main__':
     unittest.main()